@@ -20,6 +20,30 @@ USE_SERIALPORT_MIDI = False             # Set to True to enable MIDI IN via Seri
 USE_I2C_7SEGMENTDISPLAY = False         # Set to True to use a 7-segment display via I2C
 USE_BUTTONS = False                     # Set to True to use momentary buttons (connected to RaspberryPi's GPIO pins) to change preset
 MAX_POLYPHONY = 2                       # This can be set higher, but 80 is a safe value
+VOICE_STEALING = 'oldest'               # Voice to reuse when all MAX_POLYPHONY voices are busy: 'oldest', 'quietest' or 'samenote'
+MIXER_THREADS = 1                       # Cores used to mix the voices (up to 4 on a Pi 2/3), more allows a higher MAX_POLYPHONY
+INTERPOLATION = 'linear'                # Resampling of pitched samples: 'linear', 'cubic' or 'sinc' (better quality, fewer voices, see README)
+BUFFER_FRAMES = 128                     # Audio buffer size (latency = BUFFER_FRAMES / 44100 s)
+ADAPTIVE_LATENCY = False                # Adapt to the measured callback times: fewer voices when near the deadline, a bigger buffer (from the next preset) after xruns
+LATENCY_PROFILES = [64, 128, 256]       # With ADAPTIVE_LATENCY, the buffer sizes to grow to
+LIMITER = True                          # Soft limiter on the output (0.7 ms more latency): loud chords are turned down instead of clipping
+                                        # (the default volume stays at -12dB, %%volume can raise a preset into its range)
+SAMPLE_STORAGE = 'memory'               # 'memory' reads samples into RAM, 'mmap' maps them from the WAV files (big presets, near instant loading),
+                                        # 'stream' keeps only the attack of each sample in RAM and streams the rest from disk while playing
+MMAP_PREFETCH = True                    # With 'mmap' storage, read the samples into the page cache in the background after loading
+STREAM_HEAD_MS = 500                    # With 'stream' storage, length of the attack kept in RAM
+STREAM_AHEAD_MS = 1000                  # With 'stream' storage, how far ahead of each playing voice the disk is read
+RECENT_NOTES_SECONDS = 3                # When a preset loads, the samples of the notes played in the last seconds are loaded first
+LOADING_THREADS = 4                     # Samples of a preset are decoded in parallel by this many threads (one per core)
+PRESET_CACHE_MB = 0                     # Recently used presets are kept in memory up to this size, switching back to them is instant, 0 = off
+                                        # (the outgoing preset stays in RAM while the next one loads: leave room for both)
+MIPMAP_OCTAVES = 0                      # 1-3: after loading, render copies of the samples pitched up by 1..3 octaves (more RAM, no aliasing, less CPU), 0 = off
+SAMPLE_FORMAT = 'int16'                 # 'int16' (least RAM, for boards with little memory) or 'float32': 24-bit and float WAVs keep their precision (twice the RAM for them)
+DITHER_24BIT = False                    # With 'int16', 24-bit samples are reduced to 16-bit with dither instead of truncation
+SAMPLE_CACHE_DIR = ''                   # Directory where decoded samples are cached to speed up preset loading (e.g. "/home/pi/.samplecache"), empty = no cache
+STATS_INTERVAL = 0                      # Seconds between two snapshots of the engine statistics (callback times, voices, xruns, MIDI latency), 0 = off
+STATS_FILE = ''                         # With STATS_INTERVAL, append the snapshots as JSON lines to this file ('-' = print them)
+STATS_SOCKET = ''                       # With STATS_INTERVAL, serve the last snapshot on this UNIX socket (e.g. "/tmp/samplerbox.sock")
 LOCAL_CONFIG = 'local_config.py'	# Local config filename
 DEBUG = False                           # Enable to switch verbose logging on
 
@@ -33,174 +57,242 @@ if os.path.isfile(LOCAL_CONFIG):
 # MODULES
 #########################################
 
-import wave
 import time
 import numpy
 import os
 import sys
-import re
 import pyaudio
 import threading
-from chunk import Chunk
-import struct
+import bisect
+from multiprocessing.pool import ThreadPool
 import rtmidi_python as rtmidi
 import samplerbox_audio                         # legacy audio (pre RPi-2 models)
+from samplerbox_cache import SampleCache, PresetCache
+from samplerbox_latency import LatencyController
+from samplerbox_stats import StatsExporter
+import samplerbox_definition
+import samplerbox_wav
 #import samplerbox_audio_neon as samplerbox_audio # ARM NEON instruction set
 
-CARDS = sys.argv[1].split(',')
-CARD1 = CARDS[0]
-CARD2 = CARDS[1] if len(CARDS) == 2 else ''
+CARDS = sys.argv[1].split(',')         # one output bus per card, the first card's clock drives the mixing
+KICK_BUS = 1 if len(CARDS) > 1 else 0   # kicks play on the second card if there is one
 MIDI_CH = int(sys.argv[4])
 MAX_POLYPHONY = int(sys.argv[3])
 SAMPLES_DIR = sys.argv[2] + '/samples'
 KICKS_DIR = sys.argv[2] + '/kicks'
 
-#########################################
-# SLIGHT MODIFICATION OF PYTHON'S WAVE MODULE
-# TO READ CUE MARKERS & LOOP MARKERS
-#########################################
-
-class waveread(wave.Wave_read):
-
-    def initfp(self, file):
-        self._convert = None
-        self._soundpos = 0
-        self._cue = []
-        self._loops = []
-        self._ieee = False
-        self._file = Chunk(file, bigendian=0)
-        if self._file.getname() != 'RIFF':
-            raise Error, 'file does not start with RIFF id'
-        if self._file.read(4) != 'WAVE':
-            raise Error, 'not a WAVE file'
-        self._fmt_chunk_read = 0
-        self._data_chunk = None
-        while 1:
-            self._data_seek_needed = 1
-            try:
-                chunk = Chunk(self._file, bigendian=0)
-            except EOFError:
-                break
-            chunkname = chunk.getname()
-            if chunkname == 'fmt ':
-                self._read_fmt_chunk(chunk)
-                self._fmt_chunk_read = 1
-            elif chunkname == 'data':
-                if not self._fmt_chunk_read:
-                    raise Error, 'data chunk before fmt chunk'
-                self._data_chunk = chunk
-                self._nframes = chunk.chunksize // self._framesize
-                self._data_seek_needed = 0
-            elif chunkname == 'cue ':
-                numcue = struct.unpack('<i', chunk.read(4))[0]
-                for i in range(numcue):
-                    id, position, datachunkid, chunkstart, blockstart, sampleoffset = struct.unpack('<iiiiii', chunk.read(24))
-                    self._cue.append(sampleoffset)
-            elif chunkname == 'smpl':
-                manuf, prod, sampleperiod, midiunitynote, midipitchfraction, smptefmt, smpteoffs, numsampleloops, samplerdata = struct.unpack(
-                    '<iiiiiiiii', chunk.read(36))
-                for i in range(numsampleloops):
-                    cuepointid, type, start, end, fraction, playcount = struct.unpack('<iiiiii', chunk.read(24))
-                    self._loops.append([start, end])
-            chunk.skip()
-        if not self._fmt_chunk_read or not self._data_chunk:
-            raise Error, 'fmt chunk and/or data chunk missing'
-
-    def getmarkers(self):
-        return self._cue
-
-    def getloops(self):
-        return self._loops
-
-
 #########################################
 # MIXER CLASSES
 #
 #########################################
 
-class PlayingSound:
-
-    def __init__(self, sound, note, velocity, doublenote, iskick):
-        self.sound = sound
-        self.pos = 0
-        self.fadeoutpos = 0
-        self.isfadeout = False
-        self.note = note
-        self.velocity = velocity
-        self.doublenote = doublenote
-        self.iskick = iskick
-
-    def fadeout(self, i):
-        self.isfadeout = True
-
-    def stop(self):
-        try:
-            if CARD2 and self.iskick:
-                playingsounds2.remove(self)
-            else:
-                playingsounds1.remove(self)
-        except:
-            pass
-
-
 class Sound:
 
-    def __init__(self, filename, midinote, velocity, samplegain, doublenote):
-        wf = waveread(filename)
+    def __init__(self, filename, midinote, velocity, samplegain, doublenote, bus=0, voicing=None):
         self.fname = filename
         self.midinote = midinote
         self.velocity = velocity
         self.samplegain = samplegain
         self.doublenote = doublenote
-        if wf.getloops():
-            self.loop = wf.getloops()[0][0]
-            self.nframes = wf.getloops()[0][1] + 2
+        self.bus = bus
+        self.envelope, self.velocitytable = voicing or DEFAULTVOICING    # of its preset, see ApplyDefinition
+
+        cached = samplecache.load(filename, SAMPLE_STORAGE != 'memory', SAMPLE_VARIANT) if samplecache else None
+        if cached:
+            self.data, info = cached
+            self.loop, self.nframes, self.channels = info['loop'], info['nframes'], info['channels']
         else:
-            self.loop = -1
-            self.nframes = wf.getnframes()
+            self.read(filename)
 
-        self.data = self.frames2array(wf.readframes(self.nframes), wf.getsampwidth(), wf.getnchannels())
+        self.head = self.streamhead(self.data)
+        self.mipmaps = []
 
-        wf.close()
+    def streamhead(self, data):
+        if SAMPLE_STORAGE == 'stream' and isinstance(data, numpy.memmap):
+            return numpy.array(data[:STREAM_HEAD_MS * 44100 / 1000 * self.channels])
+        return None
+
+    def read(self, filename):
+        info = samplerbox_wav.scan(filename)
+        if info.loops:
+            self.loop = info.loops[0][0]
+            self.nframes = min(info.loops[0][1] + 2, info.nframes)
+        else:
+            self.loop = -1
+            self.nframes = info.nframes
+        self.channels = info.channels     # mono samples are kept mono, the mixer reads them with a stride
+
+        if SAMPLE_STORAGE in ('mmap', 'stream') and info.isint16():
+            self.data = numpy.memmap(filename, dtype=numpy.int16, mode='r', offset=info.dataoffset, shape=(self.nframes * self.channels,))
+        else:
+            self.data = samplerbox_wav.read(filename, info, self.nframes, SAMPLE_DTYPE if info.sampwidth > 2 else numpy.int16, DITHER_24BIT)
+            if samplecache:
+                samplecache.store(filename, self.data, {'loop': self.loop, 'nframes': self.nframes, 'channels': self.channels}, SAMPLE_VARIANT)
 
-    def play(self, note, velocity):
+    def play(self, note, velocity, time=0):
         global kicknote
         global kickbend
-        actual_velocity = (1-globalvelocitysensitivity + (globalvelocitysensitivity * (velocity/127.0)))*self.samplegain
+        actual_velocity = self.velocitytable[velocity] * self.samplegain
         iskick = self.midinote == kicknote
         bend = int(kickbend * ((84.0 - note) / 127)) if (iskick or self.doublenote == kicknote) else 0
-        snd = PlayingSound(self, note + bend, actual_velocity, self.doublenote, iskick)
-        if CARD2 and iskick:
-            playingsounds2.append(snd)
-        else:
-            playingsounds1.append(snd)
-        return snd
-
-    def frames2array(self, data, sampwidth, numchan):
-        if sampwidth == 2:
-            npdata = numpy.fromstring(data, dtype=numpy.int16)
-        elif sampwidth == 3:
-            npdata = samplerbox_audio.binary24_to_int16(data, len(data)/3)
-        if numchan == 1:
-            npdata = numpy.repeat(npdata, 2)
-        return npdata
+        semitones = note + bend - self.midinote
+        data, nframes, loop, head = self.data, self.nframes, self.loop, self.head
+        if self.mipmaps and semitones >= 12:    # play the octave-down-sampled copy, at speed 1.0 on whole octaves
+            level = min(semitones // 12, len(self.mipmaps))
+            data, nframes, loop, head = self.mipmaps[level - 1]
+            semitones -= 12 * level
+        serial = mixer.noteon(data, nframes, loop, SPEED[semitones], actual_velocity, note, time, self.channels, head, self.bus, self.envelope)
+        if not serial:
+            return None     # event queue full
+        return serial       # identifies the note for mixer.fadeout/stop, ignored once it has ended or been stolen
+
+    def nbytes(self):
+        # RAM of the sample and of its octave-up copies
+        return self.data.nbytes + sum(mipmap[0].nbytes for mipmap in self.mipmaps)
+
+    def rendermipmaps(self, octaves):
+        # Copies of the sample one, two... octaves up (low-passed, one frame out of two), read from or
+        # written to the sample cache. Notes pitched up play them: on whole octaves without resampling,
+        # in between resampled by less than an octave from a band-limited source, so they do not alias.
+        data, nframes, loop = self.data, self.nframes, self.loop
+        mipmaps = []
+        for level in range(1, octaves + 1):
+            variant = 'octave%d%s' % (level, SAMPLE_VARIANT)
+            cached = samplecache.load(self.fname, SAMPLE_STORAGE != 'memory', variant) if samplecache else None
+            if cached:
+                data, info = cached
+                nframes, loop = info['nframes'], info['loop']
+            else:
+                data = self.octavedown(data[:nframes * self.channels])
+                nframes, loop = len(data) // self.channels, loop // 2 if loop != -1 else -1
+                if samplecache:
+                    samplecache.store(self.fname, data, {'loop': loop, 'nframes': nframes, 'channels': self.channels}, variant)
+            mipmaps.append((data, nframes, loop, self.streamhead(data)))
+        self.mipmaps = mipmaps
+
+    def octavedown(self, data):
+        frames = numpy.asarray(data, numpy.float32).reshape(-1, self.channels)
+        res = numpy.empty(((len(frames) + 1) // 2, self.channels), numpy.float32)
+        for c in range(self.channels):
+            res[:, c] = numpy.convolve(frames[:, c], HALFBAND, 'same')[::2]
+        if data.dtype == numpy.float32:
+            return res.ravel()
+        return numpy.clip(res, -32768, 32767).astype(numpy.int16).ravel()
+
+    def prefetch(self):
+        # Touch one sample per 4 KB page so the whole mapping is in the page cache before it is played
+        if isinstance(self.data, numpy.memmap):
+            self.data[::2048].sum()
+
+
+DRIFT_SLACK = 8       # frames the smoothed FIFO level may stray from half full before a frame is dropped or repeated
+
+class BusFifo(object):
+    # Frames mixed by the first card's callback for another card. Preallocated ring with one writer and one
+    # reader (no lock): the writer only moves tail, the reader only moves head. The buffer returned by pop()
+    # is not reused before the next pop(), PortAudio copies it in the meantime.
+    # The cards' clocks drift apart by up to ~100 ppm (a few frames per second). The reader estimates the fill
+    # level as if the writer delivered its frames continuously (from the time of the last push), smooths it,
+    # and drops or repeats a single frame when it strays from half full: the latency stays at 2.5 buffers
+    # and no whole buffer is lost. It starts, and restarts after an underrun, with silence until half full.
+    # Underruns, overruns (the new buffer is dropped) and the net dropped frames are counted, each by one thread.
+    __slots__ = ('ring', 'frames', 'capacity', 'target', 'rate', 'outputs', 'flip', 'silence', 'head', 'stamp',
+                 'level', 'primed', 'underruns', 'overruns', 'drift')
+
+    def __init__(self, frames, size=5, rate=44100, underruns=0, overruns=0, drift=0):
+        self.frames = frames
+        self.capacity = size * frames
+        self.target = (self.capacity - frames) // 2      # smoothed level: the ring is half full on average
+        self.rate = rate
+        self.ring = numpy.zeros(2 * self.capacity, numpy.int16)
+        self.outputs = [numpy.zeros(2 * frames, numpy.int16) for i in range(2)]
+        self.flip = 0
+        self.silence = numpy.zeros(2 * frames, numpy.int16)
+        self.head = 0
+        self.stamp = (0, 0.0)     # (tail, time of the last push): one attribute, so the reader gets a consistent pair
+        self.level = 0.0
+        self.primed = False
+        self.underruns = underruns
+        self.overruns = overruns
+        self.drift = drift
+
+    def push(self, data, now):
+        n = len(data) // 2
+        tail = self.stamp[0]
+        if tail + n - self.head > self.capacity:
+            self.overruns += 1
+            return
+        start = tail % self.capacity
+        first = min(n, self.capacity - start)
+        self.ring[2 * start:2 * (start + first)] = data[:2 * first]
+        self.ring[:2 * (n - first)] = data[2 * first:]
+        self.stamp = (tail + n, now)
+
+    def pop(self):
+        frames = self.frames
+        tail, pushed = self.stamp
+        head = self.head
+        level = tail - head - frames + max(0, min((time.time() - pushed) * self.rate, frames))
+        if not self.primed:
+            if level < self.target:
+                return self.silence
+            self.primed = True
+            self.level = level
+        if tail - head <= frames:
+            self.underruns += 1
+            self.primed = False
+            return self.silence
+        self.level += (level - self.level) / 128.0
+        take = frames
+        if self.level > self.target + DRIFT_SLACK:
+            take = frames + 1        # the last frame read is skipped
+            self.level -= 1
+            self.drift += 1
+        elif self.level < self.target - DRIFT_SLACK:
+            take = frames - 1        # the last frame played is repeated
+            self.level += 1
+            self.drift -= 1
+        out = self.outputs[self.flip]
+        self.flip ^= 1
+        n = min(take, frames)
+        start = head % self.capacity
+        first = min(n, self.capacity - start)
+        out[:2 * first] = self.ring[2 * start:2 * (start + first)]
+        out[2 * first:2 * n] = self.ring[:2 * (n - first)]
+        if n < frames:
+            out[2 * n:] = out[2 * n - 2:2 * n]
+        self.head = head + take
+        return out
 
 FADEOUTLENGTH = 30000
 FADEOUT = numpy.linspace(1., 0., FADEOUTLENGTH)            # by default, float64
 FADEOUT = numpy.power(FADEOUT, 6)
 FADEOUT = numpy.append(FADEOUT, numpy.zeros(FADEOUTLENGTH, numpy.float32)).astype(numpy.float32)
 SPEED = numpy.power(2, numpy.arange(0.0, 84.0)/12).astype(numpy.float32)
-
-samples = {}
-playingnotes = {}
-sustainplayingnotes = []
+SAMPLE_DTYPE = {'int16': numpy.int16, 'float32': numpy.float32}[SAMPLE_FORMAT]     # of the samples deeper than 16 bits
+SAMPLE_VARIANT = ('dither' if DITHER_24BIT else '') if SAMPLE_FORMAT == 'int16' else SAMPLE_FORMAT     # sample cache entries depend on the format and dither
+HALFBAND = numpy.sinc(0.45 * numpy.arange(-32, 33)) * 0.45 * numpy.kaiser(65, 8)   # low-pass for the octave-up copies
+
+samples = samplerbox_audio.Keymap()
+noteusage = [0] * 128            # note-ons received per MIDI note, the most played notes of a preset are loaded first
+notelastplayed = [0.0] * 128
+playingnotes = {}                # note -> serials of its playing notes (the voices live in the mixer)
+sustainplayingnotes = []         # serials of the notes held by the sustain pedal
 sustain = False
-playingsounds1 = []
-playingsounds2 = []
-globalvolume = 10 ** (-12.0/20)  # -12dB default global volume
+mixer = samplerbox_audio.Mixer(MAX_POLYPHONY * len(CARDS), BUFFER_FRAMES, FADEOUT, FADEOUTLENGTH, VOICE_STEALING, interpolation=INTERPOLATION,
+                               threads=MIXER_THREADS, outputs=len(CARDS), limiter=LIMITER)     # MAX_POLYPHONY voices per card
+busfifos = [BusFifo(BUFFER_FRAMES) for card in CARDS]      # mixed buffers waiting for the other cards' callbacks
+miditime = samplerbox_audio.Histogram()          # MidiCallback duration for note-ons
+latency = LatencyController(LATENCY_PROFILES if ADAPTIVE_LATENCY else [BUFFER_FRAMES], BUFFER_FRAMES, mixer.busvoices)    # voice limit per card
+lastmiditime = 0
+DEFAULTVOLUME = 10 ** (-12.0/20)  # default global volume
+globalvolume = DEFAULTVOLUME
 globaltranspose = 0
 kicknote = 2
 kickbend = 0
+samplecache = SampleCache(SAMPLE_CACHE_DIR) if SAMPLE_CACHE_DIR else None
+presetcache = PresetCache(PRESET_CACHE_MB * 1024 * 1024)
+loadingpool = ThreadPool(LOADING_THREADS)
 
 
 #########################################
@@ -208,39 +300,42 @@ kickbend = 0
 #
 #########################################
 
-def AudioCallback1(in_data, frame_count, time_info, status):
-    global playingsounds1
-    rmlist = []
-    playingsounds1 = playingsounds1[-MAX_POLYPHONY:]
-    b = samplerbox_audio.mixaudiobuffers(playingsounds1, rmlist, frame_count, FADEOUT, FADEOUTLENGTH, SPEED, globalvolume)
-    for e in rmlist:
-        try:
-            playingsounds1.remove(e)
-        except:
-            pass
-#    odata = (b.astype(numpy.int16)).tostring()
-    odata = b.tostring()
-    return (odata, pyaudio.paContinue)
-
-def AudioCallback2(in_data, frame_count, time_info, status):
-    global playingsounds2
-    rmlist = []
-    playingsounds2 = playingsounds2[-MAX_POLYPHONY:]
-    b = samplerbox_audio.mixaudiobuffers(playingsounds2, rmlist, frame_count, FADEOUT, FADEOUTLENGTH, SPEED, globalvolume)
-    for e in rmlist:
-        try:
-            playingsounds2.remove(e)
-        except:
-            pass
-#    odata = (b.astype(numpy.int16)).tostring()
-    odata = b.tostring()
-    return (odata, pyaudio.paContinue)
+def AudioCallback(in_data, frame_count, time_info, status):
+    # First card: mixes all the buses in one pass, keeps bus 0 and queues the others for their cards.
+    # The FIFOs absorb the drift between the cards' clocks (a single frame is dropped or repeated now and then).
+    # The preallocated output buffers go to PortAudio as they are (buffer protocol): nothing is allocated or copied here.
+    now = time.time()
+    mixer.mix(frame_count, globalvolume, now)
+    for bus in range(1, len(CARDS)):
+        busfifos[bus].push(mixer.outputbuffers[bus], now)
+    latency.callback(time.time() - now, status & pyaudio.paOutputUnderflow,
+                     time_info['output_buffer_dac_time'] - time_info['current_time'])
+    return (mixer.outputbuffers[0], pyaudio.paContinue)
+
+def BusCallback(bus):
+    # Callback of the other cards: plays what the first card's callback mixed for them
+    def callback(in_data, frame_count, time_info, status):
+        return (busfifos[bus].pop(), pyaudio.paContinue)
+    return callback
+
+def MidiEventTime(time_stamp):
+    # rtmidi's time_stamp is the delta since the previous message: chaining the deltas keeps the spacing
+    # of messages that reach us in a burst. Re-anchor on the wall clock after pauses, drift, or serial MIDI (None).
+    global lastmiditime
+    now = time.time()
+    t = lastmiditime + time_stamp if (time_stamp is not None and lastmiditime) else now
+    if t > now or now - t > 0.005:
+        t = now
+    lastmiditime = t
+    return t
 
 def MidiCallback(message, time_stamp):
     global playingnotes, sustain, sustainplayingnotes
     global preset
     global kickpreset
     global kickbend
+    start = time.time()
+    t = MidiEventTime(time_stamp)
     messagetype = message[0] >> 4
     if messagetype == 15:    # Ignore system messages
         return
@@ -255,19 +350,19 @@ def MidiCallback(message, time_stamp):
 
     if messagetype == 9: # Note on
         if note == 1:    # Use note 1 as note off
-            for s in playingsounds2:
-                s.fadeout(50)
-            for s in playingsounds1:
-                s.fadeout(50)
+            mixer.fadeoutall()
         else:
+            noteusage[note] += 1
+            notelastplayed[note] = t
             midinote += globaltranspose
             try:
-                samples[midinote, velocity].play(midinote, velocity)
-                doublenote = samples[midinote, velocity].doublenote
-                if doublenote != 0:
-                    samples[doublenote, velocity].play(doublenote, velocity)
+                sound = samples.lookup(midinote, velocity)
+                sound.play(midinote, velocity, t)
+                if sound.doublenote != 0:
+                    samples.lookup(sound.doublenote, velocity).play(sound.doublenote, velocity, t)
             except:
                 pass
+            miditime.add(time.time() - start)
 
     elif (messagetype == 11) and (note == 2):  # CC #2
         kickbend = velocity
@@ -285,8 +380,8 @@ def MidiCallback(message, time_stamp):
         LoadSamples()
 
     elif (messagetype == 11) and (note == 64) and (velocity < 64):  # sustain pedal off
-        for n in sustainplayingnotes:
-            n.fadeout(50)
+        for serial in sustainplayingnotes:
+            mixer.fadeout(serial)
         sustainplayingnotes = []
         sustain = False
 
@@ -317,19 +412,128 @@ def LoadSamples():
     LoadingThread.daemon = True
     LoadingThread.start()
 
-NOTES = ["c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b"]
+def PresetCacheKey(dirname, *extra):
+    # Name, mtime and size of every file of the directory (samples and definition): adding, removing
+    # or overwriting one of them in place gives another key, one stat per file
+    files = []
+    for fname in sorted(os.listdir(dirname)):
+        st = os.stat(os.path.join(dirname, fname))
+        files.append((fname, st.st_mtime, st.st_size))
+    return (dirname, tuple(files)) + extra
+
+def UseCachedPreset(key):
+    # Returns the preset's samples (already added to `samples`) if it is in the preset cache, else None
+    global globalvolume, globaltranspose
+    entry = presetcache.get(key)
+    if entry is None:
+        return None
+    presetsamples, volumefactor, globaltranspose = entry
+    globalvolume *= volumefactor
+    for midinote, velocity, order, sound in presetsamples:
+        samples.add(midinote, velocity, sound, order)
+    print 'Preset cache: %(hits)d hits, %(misses)d misses, %(presets)d presets in %(bytes)d bytes' % presetcache.stats()
+    return presetsamples
+
+def CachePreset(key, presetsamples, volumebefore):
+    # The %%parameters of the definition file are kept as their effect on the globals (the sounds keep their voicing)
+    if presetsamples:
+        presetcache.put(key, (list(presetsamples), globalvolume / volumebefore, globaltranspose), PresetBytes(presetsamples))
+
+def PresetBytes(presetsamples):
+    return sum(sound.nbytes() for midinote, velocity, order, sound in presetsamples)
+
+def ApplyDefinition(definition):
+    # The %%parameters of a compiled definition file: volume and transpose in the globals. Returns the voicing
+    # of the preset's sounds, (envelope, velocity table), which each Sound keeps: the kick and the preset have their own.
+    global globalvolume, globaltranspose
+    globalvolume *= definition.volume
+    if definition.transpose is not None:
+        globaltranspose = definition.transpose
+    envelope = None             # the mixer's default: no attack, FADEOUT release
+    if definition.envelope:     # computed once per preset, shared by all its notes
+        parameters = definition.envelope
+        envelope = samplerbox_audio.Envelope(parameters.get('attack', 0) / 1000.0, parameters.get('decay', 0) / 1000.0,
+                                             10 ** (parameters.get('sustain', 0) / 20.0),
+                                             parameters.get('release', 1000.0 * FADEOUTLENGTH / 44100) / 1000.0)
+    sensitivity = definition.velocitysensitivity if definition.velocitysensitivity is not None else 0
+    curve = definition.velocitycurve if definition.velocitycurve is not None else 1.0
+    return envelope, VelocityTable(sensitivity, curve)
+
+def VelocityTable(sensitivity, curve):
+    # Gain per MIDI velocity, looked up at each note-on: 1 - s + s * (velocity / 127) ^ curve
+    return [1 - sensitivity + sensitivity * (velocity / 127.0) ** curve for velocity in range(128)]
+
+DEFAULTVOICING = (None, VelocityTable(0, 1.0))      # sounds without definition file
+
+def MatchDefinition(definition, dirname, message):
+    # Every (rule, file) match of the directory, the directory is listed once
+    hits, errors = definition.match(os.listdir(dirname))
+    for line in sorted(set(definition.errors + errors)):
+        print message % line
+    return hits
+
+def PlanPreset(dirname):
+    # Reads the definition file (the %%parameters are applied) and matches the preset's files once:
+    # returns the list of samples to load as ((midinote, velocity, roundrobin), filename, samplegain, doublenote, bus, line, voicing),
+    # or None if loading was interrupted. When several files match a key the last one wins, as before,
+    # unless they differ by %roundrobin: then they are played in turn.
+    plan = {}
+    definition = samplerbox_definition.load(os.path.join(dirname, "definition.txt"))
+    if definition:
+        voicing = ApplyDefinition(definition)
+        for line, fname, midinote, velocity, roundrobin, samplegain, doublenote, bus in \
+                MatchDefinition(definition, dirname, "Error in definition file, skipping line %s."):
+            if LoadingInterrupt:
+                return None
+            bus = min(bus, len(CARDS) - 1)
+            plan[midinote, velocity, roundrobin] = ((midinote, velocity, roundrobin), os.path.join(dirname, fname), samplegain, doublenote, bus, line, voicing)
+    else:
+        fnames = os.listdir(dirname)
+        for midinote in range(0, 127):
+            if "%d.wav" % midinote in fnames:
+                plan[midinote, 127, 0] = ((midinote, 127, 0), os.path.join(dirname, "%d.wav" % midinote), 100, 0, 0, None, None)
+    return plan.values()
+
+def SortPlan(plan):
+    # Load first the samples of the notes played in the last seconds (likely still held, or about to be
+    # played again), then the samples of the most played notes, then the rest from the lowest note up.
+    # A played note counts for the sample it would play: the highest sampled note at or below it.
+    ownnotes = sorted(set(job[0][0] for job in plan))
+    recent = set()
+    usage = {}
+    now = time.time()
+    for note in xrange(128):
+        if noteusage[note]:
+            i = bisect.bisect_right(ownnotes, note + globaltranspose) - 1
+            if i >= 0:
+                usage[ownnotes[i]] = usage.get(ownnotes[i], 0) + noteusage[note]
+                if now - notelastplayed[note] < RECENT_NOTES_SECONDS:
+                    recent.add(ownnotes[i])
+    plan.sort(key=lambda job: (job[0][0] not in recent, -usage.get(job[0][0], 0), job[0]))
+
+def LoadPlannedSound(job):
+    # Runs in the loading pool: file reads and sample conversion release the GIL, so the decoding uses all cores
+    key, filename, samplegain, doublenote, bus, line, voicing = job
+    if LoadingInterrupt:
+        return key, None
+    try:
+        return key, Sound(filename, key[0], key[1], samplegain, doublenote, bus, voicing)
+    except:
+        if line:
+            print "Error in definition file, skipping line %s." % line
+        else:
+            print "Error loading %s, skipping." % filename
+        return key, None
 
 def ActuallyLoad():
     global preset
     global samples
-    global playingsounds1
     global globalvolume, globaltranspose
-    global globalvelocitysensitivity
-    playingsounds1 = []
-    samples = {}
-    globalvolume = 10 ** (-12.0/20)  # -12dB default global volume
+    mixer.stopall()
+    ApplyPendingFrames()    # no notes are playing, a bigger buffer asked by the latency controller can be applied
+    samples = samplerbox_audio.Keymap()
+    globalvolume = DEFAULTVOLUME
     globaltranspose = 0
-    globalvelocitysensitivity = 0 # default midi velocity sensitivity 
 
     ActuallyLoadKick()
 
@@ -343,87 +547,63 @@ def ActuallyLoad():
     print 'Preset loading: %s (%s)' % (preset, basename)
     display("L%03d" % preset)
 
-    definitionfname = os.path.join(dirname, "definition.txt")
-    if os.path.isfile(definitionfname):
-        with open(definitionfname, 'r') as definitionfile:
-            for i, pattern in enumerate(definitionfile):
-                try:
-                    if r'%%volume' in pattern:        # %%paramaters are global parameters
-                        globalvolume *= 10 ** (float(pattern.split('=')[1].strip()) / 20)
-                        continue
-                    if r'%%transpose' in pattern:
-                        globaltranspose = int(pattern.split('=')[1].strip())
-                        continue
-                    if r'%%velocitysensitivity' in pattern:
-                        globalvelocitysensitivity = float(pattern.split('=')[1].strip())
-                        continue
-                    defaultparams = {'midinote': '0', 'velocity': '127', 'samplegain': '100', 'doublenote': '0', 'notename': ''}
-                    if len(pattern.split(',')) > 1:
-                        defaultparams.update(dict([item.split('=') for item in pattern.split(',', 1)[1].replace(' ', '').replace('%', '').split(',')]))
-                    pattern = pattern.split(',')[0]
-                    pattern = re.escape(pattern.strip())
-                    pattern = pattern.replace(r"\%midinote", r"(?P<midinote>\d+)").replace(r"\%velocity", r"(?P<velocity>\d+)").replace(r"\%samplegain", r"(?P<samplegain>\d+)")\
-                                     .replace(r"\%doublenote", r"(?P<doublenote>\d+)").replace(r"\%notename", r"(?P<notename>[A-Ga-g]#?[0-9])").replace(r"\*", r".*?").strip()    # .*? => non greedy
-                    for fname in os.listdir(dirname):
-                        if LoadingInterrupt:
-                            return
-                        m = re.match(pattern, fname)
-                        if m:
-                            info = m.groupdict()
-                            midinote = int(info.get('midinote', defaultparams['midinote']))
-                            velocity = int(info.get('velocity', defaultparams['velocity']))
-                            samplegain = float(info.get('samplegain', defaultparams['samplegain']))/100
-                            doublenote = int(info.get('doublenote', defaultparams['doublenote']))
-                            notename = info.get('notename', defaultparams['notename'])
-                            if notename:
-                                midinote = NOTES.index(notename[:-1].lower()) + (int(notename[-1])+2) * 12
-                            samples[midinote, velocity] = Sound(os.path.join(dirname, fname), midinote, velocity, samplegain, doublenote)
-                except:
-                    print "Error in definition file, skipping line %s." % (i+1)
+    cachekey = PresetCacheKey(dirname)
+    volumebefore = globalvolume
+    presetsamples = UseCachedPreset(cachekey)
+    if presetsamples is None:
+        presetsamples = []
+        samples.fill()
+        plan = PlanPreset(dirname)
+        if plan is None:
+            return
+        SortPlan(plan)
+        lastfill = 0
+        for (midinote, velocity, roundrobin), sound in loadingpool.imap_unordered(LoadPlannedSound, plan):
+            if sound and not LoadingInterrupt:    # on interrupt the remaining jobs return at once, let them drain
+                samples.add(midinote, velocity, sound, roundrobin)
+                presetsamples.append((midinote, velocity, roundrobin, sound))
+                if time.time() - lastfill > 0.05:  # samples become playable as they arrive, the table is updated in batches
+                    samples.fill()
+                    lastfill = time.time()
+        if LoadingInterrupt:
+            return
+        CachePreset(cachekey, presetsamples, volumebefore)
+    samples.fill()
 
-    else:
-        for midinote in range(0, 127):
-            if LoadingInterrupt:
-                return
-            file = os.path.join(dirname, "%d.wav" % midinote)
-            if os.path.isfile(file):
-                samples[midinote, 127] = Sound(file, midinote, 127, 100, 0)
-
-    initial_keys = set(samples.keys())
-    for midinote in xrange(128):
-        lastvelocity = None
-        for velocity in xrange(128):
-            if (midinote, velocity) not in initial_keys:
-                samples[midinote, velocity] = lastvelocity
-            else:
-                if not lastvelocity:
-                    for v in xrange(velocity):
-                        samples[midinote, v] = samples[midinote, velocity]
-                lastvelocity = samples[midinote, velocity]
-        if not lastvelocity:
-            for velocity in xrange(128):
-                try:
-                    samples[midinote, velocity] = samples[midinote-1, velocity]
-                except:
-                    pass
-    if len(initial_keys) > 0:
+    if len(samples) > 0:
         print 'Preset loaded: ' + str(preset)
         display("%04d" % preset)
+        if MIPMAP_OCTAVES:
+            RenderMipmaps()
+            presetcache.recount(lambda entry: PresetBytes(entry[0]))    # the copies are rendered after the presets are cached
+        if SAMPLE_STORAGE == 'mmap' and MMAP_PREFETCH:
+            for sound in samples.sounds():
+                if LoadingInterrupt:
+                    return
+                sound.prefetch()
     else:
         print 'Preset empty: ' + str(preset)
         display("E%03d" % preset)
 
 
+def RenderMipmaps():
+    # Samples played an octave or more above their root note (and the kick, bent up) get octave-up copies
+    sounds = [sound for sound, highest in samples.reach() if highest - sound.midinote >= 12 or
+              sound.midinote == kicknote or sound.doublenote == kicknote]
+    for sound in loadingpool.imap_unordered(RenderMipmapsOf, set(sounds)):
+        pass
+
+def RenderMipmapsOf(sound):
+    if not LoadingInterrupt and not sound.mipmaps:      # sounds of a cached preset already have them
+        sound.rendermipmaps(MIPMAP_OCTAVES)
+
+
 def ActuallyLoadKick():
     global kickpreset
     global kicknote
     global samples
-    global playingsounds2
     global globalvolume, globaltranspose
-    global globalvelocitysensitivity
 
-    if CARD2:
-        playingsounds2 = []
     dirname = KICKS_DIR
     if not dirname:
         print 'Kick dir missing'
@@ -431,56 +611,41 @@ def ActuallyLoadKick():
     print 'Kick preset loading: %s (%s)' % (kickpreset, dirname)
     display("L%03d" % kickpreset)
 
-    definitionfname = os.path.join(dirname, "definition.txt")
-    if os.path.isfile(definitionfname):
-        with open(definitionfname, 'r') as definitionfile:
-            for i, pattern in enumerate(definitionfile):
-                try:
-                    if r'%%volume' in pattern:        # %%paramaters are global parameters
-                        globalvolume *= 10 ** (float(pattern.split('=')[1].strip()) / 20)
-                        continue
-                    if r'%%transpose' in pattern:
-                        globaltranspose = int(pattern.split('=')[1].strip())
-                        continue
-                    if r'%%velocitysensitivity' in pattern:
-                        globalvelocitysensitivity = float(pattern.split('=')[1].strip())
-                        continue
-                    defaultparams = {'midinote': '0', 'velocity': '127', 'samplegain': '100', 'doublenote': '0', 'notename': ''}
-                    if len(pattern.split(',')) > 1:
-                        defaultparams.update(dict([item.split('=') for item in pattern.split(',', 1)[1].replace(' ', '').replace('%', '').split(',')]))
-                    pattern = pattern.split(',')[0]
-                    pattern = re.escape(pattern.strip())
-                    pattern = pattern.replace(r"\%midinote", r"(?P<midinote>\d+)").replace(r"\%velocity", r"(?P<velocity>\d+)").replace(r"\%samplegain", r"(?P<samplegain>\d+)")\
-                                     .replace(r"\%doublenote", r"(?P<doublenote>\d+)").replace(r"\%notename", r"(?P<notename>[A-Ga-g]#?[0-9])").replace(r"\*", r".*?").strip()    # .*? => non greedy
-                    for fname in os.listdir(dirname):
-                        if LoadingInterrupt:
-                            return
-                        m = re.match(pattern, fname)
-                        if m:
-                            info = m.groupdict()
-                            midinote = int(info.get('midinote', defaultparams['midinote']))
-                            velocity = int(info.get('velocity', defaultparams['velocity']))
-                            samplegain = float(info.get('samplegain', defaultparams['samplegain']))/100
-                            doublenote = 0   # not used for kicks
-                            notename = info.get('notename', defaultparams['notename'])
-                            if notename:
-                                midinote = NOTES.index(notename[:-1].lower()) + (int(notename[-1])+2) * 12
-                            if midinote != kickpreset:
-                                continue
-
-                            samples[kicknote, velocity] = Sound(os.path.join(dirname, fname), kicknote, velocity, samplegain, doublenote)
-                            print 'Kick preset loaded: ' + str(kickpreset)
-                            display("%04d" % kickpreset)
-                            return
-                except:
-                    print "Error in kick definition file, skipping line %s." % (i+1)
+    cachekey = PresetCacheKey(dirname, kickpreset)
+    volumebefore = globalvolume
+    if UseCachedPreset(cachekey) is not None:
+        print 'Kick preset loaded: ' + str(kickpreset)
+        display("%04d" % kickpreset)
+        return
+
+    definition = samplerbox_definition.load(os.path.join(dirname, "definition.txt"))
+    if definition:
+        voicing = ApplyDefinition(definition)
+        for line, fname, midinote, velocity, roundrobin, samplegain, doublenote, bus in \
+                MatchDefinition(definition, dirname, "Error in kick definition file, skipping line %s."):
+            if LoadingInterrupt:
+                return
+            if midinote != kickpreset:
+                continue
+            try:
+                sound = Sound(os.path.join(dirname, fname), kicknote, velocity, samplegain, 0, KICK_BUS, voicing)   # doublenote not used for kicks
+            except:
+                print "Error in kick definition file, skipping line %s." % line
+                continue
+            samples.add(kicknote, velocity, sound)
+            CachePreset(cachekey, [(kicknote, velocity, 0, sound)], volumebefore)
+            print 'Kick preset loaded: ' + str(kickpreset)
+            display("%04d" % kickpreset)
+            return
 
     else:
         if LoadingInterrupt:
             return
         file = os.path.join(dirname, "%d.wav" % kicknote)
         if os.path.isfile(file):
-            samples[kicknote, 127] = Sound(file, kicknote, 127, 100, 0)
+            sound = Sound(file, kicknote, 127, 100, 0, KICK_BUS)
+            samples.add(kicknote, 127, sound)
+            CachePreset(cachekey, [(kicknote, 127, 0, sound)], volumebefore)
             print 'Kick preset loaded: ' + str(kickpreset)
             display("%04d" % kickpreset)
             return
@@ -495,28 +660,55 @@ def ActuallyLoadKick():
 #########################################
 
 p = pyaudio.PyAudio()
+AUDIO_DEVICE_IDS = [None] * len(CARDS)
 for i in range(p.get_device_count()):
     dev = p.get_device_info_by_index(i)
     # Find card name using aplay -l
     # print "checking device: " + str(i) + " " + str(dev['maxOutputChannels']) + " " + sys.argv[1] + " " + dev['name']
     if dev['maxOutputChannels'] > 0:
-        if CARD1 in dev['name']:
-            print "CARD1 device: index=" + str(i) + " name=" + dev['name']
-            AUDIO_DEVICE_ID1 = i
-        elif CARD2 and CARD2 in dev['name']:
-            print "CARD2 device: index=" + str(i) + " name=" + dev['name']
-            AUDIO_DEVICE_ID2 = i
+        for bus, card in enumerate(CARDS):
+            if AUDIO_DEVICE_IDS[bus] is None and card in dev['name']:
+                print "CARD%d device: index=%d name=%s" % (bus + 1, i, dev['name'])
+                AUDIO_DEVICE_IDS[bus] = i
+                break
+
+streams = []
+
+def OpenStreams(frames):
+    # (Re)open all the cards with a buffer size of `frames`. Streams are closed first, so the callbacks
+    # are not running while the FIFOs and the mixer buffers are replaced.
+    global streams, busfifos
+    for stream in streams:
+        stream.stop_stream()
+        stream.close()
+    streams = []
+    busfifos = [BusFifo(frames, underruns=fifo.underruns, overruns=fifo.overruns, drift=fifo.drift) for fifo in busfifos]   # counts survive a reopen
+    mixer.resize(frames)
+    for bus, deviceid in enumerate(AUDIO_DEVICE_IDS):
+        streams.append(p.open(format=pyaudio.paInt16, channels=2, rate=44100, frames_per_buffer=frames, output=True,
+                              input=False, output_device_index=deviceid, stream_callback=AudioCallback if bus == 0 else BusCallback(bus)))
+        print 'Opened audio%d: %s (%d frames)' % (bus + 1, p.get_device_info_by_index(deviceid)['name'], frames)
+
+pendingframes = None    # buffer size asked by the latency controller, applied between presets
+
+def ApplyPendingFrames():
+    global pendingframes
+    frames = pendingframes
+    if not frames:
+        return
+    pendingframes = None
+    try:
+        OpenStreams(frames)
+    except IOError:
+        print 'Could not open the cards with %d frames, back to %d' % (frames, BUFFER_FRAMES)
+        latency.profiles.remove(frames)
+        latency.frames = BUFFER_FRAMES
+        OpenStreams(BUFFER_FRAMES)
 
 try:
-    stream1 = p.open(format=pyaudio.paInt16, channels=2, rate=44100, frames_per_buffer=128, output=True,
-                    input=False, output_device_index=AUDIO_DEVICE_ID1, stream_callback=AudioCallback1)
-    print 'Opened audio1: ' + p.get_device_info_by_index(AUDIO_DEVICE_ID1)['name']
-    if CARD2:
-        stream2 = p.open(format=pyaudio.paInt16, channels=2, rate=44100, frames_per_buffer=128, output=True,
-                        input=False, output_device_index=AUDIO_DEVICE_ID2, stream_callback=AudioCallback2)
-        print 'Opened audio2: ' + p.get_device_info_by_index(AUDIO_DEVICE_ID2)['name']
+    OpenStreams(BUFFER_FRAMES)
 except:
-    print "Invalid Audio Device ID: " + str(AUDIO_DEVICE_ID1) + " or " + str(AUDIO_DEVICE_ID2)
+    print "Invalid Audio Device ID: " + " or ".join(str(deviceid) for deviceid in AUDIO_DEVICE_IDS)
     print "Here is a list of audio devices:"
     for i in range(p.get_device_count()):
         dev = p.get_device_info_by_index(i)
@@ -526,6 +718,51 @@ except:
     exit(1)
 
 
+#########################################
+# ADAPTIVE LATENCY THREAD
+#
+#########################################
+
+if ADAPTIVE_LATENCY:
+
+    def LatencyControl():
+        # Low priority: once per window, apply the controller's decision (see samplerbox_latency.py).
+        # Reopening the cards would cut the notes, so a new buffer size waits for the next preset load.
+        global pendingframes
+        while True:
+            time.sleep(latency.window)
+            before = latency.changes[-1] if latency.changes else None
+            frames = latency.update()
+            mixer.voicelimit = latency.voicelimit
+            if frames:
+                pendingframes = frames
+            if DEBUG and latency.changes and latency.changes[-1] is not before:
+                print 'Latency: %d frames, %d voices (%s)' % latency.changes[-1][1:]
+
+    LatencyThread = threading.Thread(target=LatencyControl)
+    LatencyThread.daemon = True
+    LatencyThread.start()
+
+
+#########################################
+# STATISTICS THREAD
+#
+#########################################
+
+if STATS_INTERVAL:
+    # mixer: mix() durations, active voices, stolen voices, note-on to buffer latency (add latency's outputlatency_ms
+    # for the time to the DAC). latency: callback load and xruns. midi: MidiCallback durations.
+    # buses: underruns/overruns and drift correction of the FIFOs feeding the other cards.
+    def BusStats():
+        # per bus (the first card has no FIFO): buffers played as silence, buffers dropped, frames dropped minus repeated
+        return {'underruns': [fifo.underruns for fifo in busfifos[1:]], 'overruns': [fifo.overruns for fifo in busfifos[1:]],
+                'drift': [fifo.drift for fifo in busfifos[1:]]}
+
+    StatsThread = StatsExporter({'mixer': mixer.stats, 'latency': latency.stats, 'midi': miditime.snapshot,
+                                 'presetcache': presetcache.stats, 'buses': BusStats}, STATS_INTERVAL, STATS_FILE, STATS_SOCKET)
+    StatsThread.start()
+
+
 #########################################
 # BUTTONS THREAD (RASPBERRY PI GPIO)
 #
@@ -564,6 +801,27 @@ if USE_BUTTONS:
     ButtonsThread.start()
 
 
+#########################################
+# DISK STREAMING THREAD
+#
+#########################################
+
+if SAMPLE_STORAGE == 'stream':
+
+    def Streamer():
+        # Stay ahead of every streamed voice: read the next STREAM_AHEAD_MS of its sample into the page cache,
+        # so the audio thread finds it in memory once the voice has played past its in-RAM head
+        ahead = STREAM_AHEAD_MS * 44100 / 1000
+        while True:
+            for data, pos, channels in mixer.streamingvoices():
+                data[pos * channels:(pos + ahead) * channels:2048].sum()
+            time.sleep(0.005)
+
+    StreamerThread = threading.Thread(target=Streamer)
+    StreamerThread.daemon = True
+    StreamerThread.start()
+
+
 #########################################
 # 7-SEGMENT DISPLAY
 #
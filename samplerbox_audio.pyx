@@ -68,11 +68,6 @@ def mixaudiobuffers(list playingsounds, list rmlist, int frame_count, numpy.ndar
 
     return b.astype(numpy.int16)
 
-def binary24_to_int16(char *data, int length):
-    cdef int i
-    res = numpy.zeros(length, numpy.int16)
-    b = <char *>((<numpy.ndarray>res).data)
-    for i in range(length):
-        b[2*i] = data[3*i+1]
-        b[2*i+1] = data[3*i+2]
-    return res
+
+include "samplerbox_convert.pxi"
+include "samplerbox_engine.pxi"
@@ -168,11 +168,6 @@ def mixing_channels(int sounds):
       sounds += 1
     return sounds + 8
 
-def binary24_to_int16(char *data, int length):
-    cdef int i
-    res = numpy.zeros(length, numpy.int16)
-    b = <char *>((<numpy.ndarray>res).data)
-    for i in range(length):
-        b[2*i] = data[3*i+1]
-        b[2*i+1] = data[3*i+2]
-    return res
+
+include "samplerbox_convert.pxi"
+include "samplerbox_engine.pxi"
@@ -0,0 +1,255 @@
+#
+#  SamplerBox
+#
+#  author:    Joseph Ernest (twitter: @JosephErnest, mail: contact@samplerbox.org)
+#  url:       http://www.samplerbox.org/
+#  license:   Creative Commons ShareAlike 3.0 (http://creativecommons.org/licenses/by-sa/3.0/)
+#
+#  samplerbox_bench.py: Offline mixer benchmark
+#
+#  Drives the audio engine directly with synthetic sounds, no sound card / PyAudio needed.
+#  Example: python samplerbox_bench.py --voices 1,8,32,64 --frames 128
+#           python samplerbox_bench.py --module samplerbox_audio_neon --quick
+#           python samplerbox_bench.py --format int16,float32 --interpolation cubic
+#
+
+
+import argparse
+import time
+import numpy
+
+RATE = 44100
+
+# Same tables as samplerbox.py (kept in sync by hand, samplerbox.py opens the sound card on import)
+FADEOUTLENGTH = 30000
+FADEOUT = numpy.linspace(1., 0., FADEOUTLENGTH)
+FADEOUT = numpy.power(FADEOUT, 6)
+FADEOUT = numpy.append(FADEOUT, numpy.zeros(FADEOUTLENGTH, numpy.float32)).astype(numpy.float32)
+SPEED = numpy.power(2, numpy.arange(0.0, 84.0)/12).astype(numpy.float32)
+GLOBALVOLUME = 10 ** (-12.0/20)
+
+
+#########################################
+# SYNTHETIC SOUNDS
+#
+#########################################
+
+class BenchSound:
+    """Stand-in for samplerbox.Sound: stereo interleaved noise (int16, or float32 in the same scale), optionally looped."""
+
+    def __init__(self, seconds, looped, midinote=60, seed=0, dtype=numpy.int16):
+        nframes = int(seconds * RATE)
+        rnd = numpy.random.RandomState(seed)
+        self.fname = 'synthetic'
+        self.midinote = midinote
+        self.velocity = 127
+        self.samplegain = 1.0
+        self.doublenote = 0
+        self.data = rnd.randint(-8000, 8000, 2 * nframes).astype(dtype)
+        if looped:
+            self.loop = nframes // 2
+            self.nframes = nframes - 2
+        else:
+            self.loop = -1
+            self.nframes = nframes
+
+
+class BenchVoice:
+    """Stand-in for the PlayingSound objects that mixaudiobuffers expects (see samplerbox_normal.py)."""
+
+    def __init__(self, sound, note, velocity, isfadeout):
+        self.sound = sound
+        self.note = note
+        self.velocity = velocity
+        self.doublenote = 0
+        self.iskick = False
+        self.reset(isfadeout)
+
+    def reset(self, isfadeout):
+        self.pos = 0
+        self.fadeoutpos = 0
+        self.isfadeout = isfadeout
+
+
+#########################################
+# SCENARIOS
+#
+#########################################
+
+PITCHES = {
+    'unity': [0],                   # drum hits played at their root note
+    'fifth': [7],
+    'octave': [12],
+    'mixed': [0, 3, 7, 12, 19, 24], # typical keyboard playing
+}
+
+
+class Scenario:
+
+    def __init__(self, voices, frames, pitch, looped, fadeout, interpolation='linear', threads=1):
+        self.voices = voices
+        self.interpolation = interpolation
+        self.threads = threads
+        self.frames = frames
+        self.pitch = pitch
+        self.looped = looped
+        self.fadeout = fadeout
+
+    def label(self):
+        return '%3d voices  %4d frames  %-6s  %-7s  %s' % (self.voices, self.frames, self.pitch,
+                                                          'looped' if self.looped else 'oneshot',
+                                                          'fadeout' if self.fadeout else 'sustain')
+
+    def budget(self):
+        return 1e6 * self.frames / RATE    # microseconds available per callback
+
+    def makevoices(self, sounds):
+        notes = PITCHES[self.pitch]
+        return [BenchVoice(sounds[self.looped], sounds[self.looped].midinote + notes[n % len(notes)], 0.8, self.fadeout)
+                for n in range(self.voices)]
+
+
+def makesounds(dtype=numpy.int16):
+    # 4 second samples: long enough that a one-shot voice survives a whole measurement at 2 octaves up
+    return {False: BenchSound(4.0, False, seed=1, dtype=dtype), True: BenchSound(4.0, True, seed=2, dtype=dtype)}
+
+
+#########################################
+# RUNNERS
+#
+#########################################
+
+def run_mixaudiobuffers(module, scenario, sounds, iterations):
+    """Time module.mixaudiobuffers the same way AudioCallback1 calls it, returns per-callback durations in us."""
+    voices = scenario.makevoices(sounds)
+    timings = numpy.zeros(iterations)
+    for it in range(iterations):
+        rmlist = []
+        t0 = time.time()
+        module.mixaudiobuffers(voices, rmlist, scenario.frames, FADEOUT, FADEOUTLENGTH, SPEED, GLOBALVOLUME)
+        timings[it] = (time.time() - t0) * 1e6
+        for v in voices:        # keep the polyphony constant: restart what the mixer has finished
+            if v in rmlist or v.fadeoutpos > FADEOUTLENGTH:
+                v.reset(scenario.fadeout)
+    return timings
+
+
+def run_mixer(module, scenario, sounds, iterations):
+    """Time the voice engine (module.Mixer) the same way AudioCallback1 calls it."""
+    mixer = module.Mixer(scenario.voices, scenario.frames, FADEOUT, FADEOUTLENGTH, interpolation=scenario.interpolation, threads=scenario.threads)
+    voices = scenario.makevoices(sounds)
+
+    def start(v):
+        v.serial = mixer.noteon(v.sound.data, v.sound.nframes, v.sound.loop, SPEED[v.note - v.sound.midinote], v.velocity, v.note)
+        if v.isfadeout:
+            mixer.fadeout(v.serial)
+
+    for v in voices:
+        start(v)
+    timings = numpy.zeros(iterations)
+    for it in range(iterations):
+        t0 = time.time()
+        mixer.mix(scenario.frames, GLOBALVOLUME)
+        timings[it] = (time.time() - t0) * 1e6
+        for v in voices:
+            if not mixer.isplaying(v.serial):
+                start(v)
+    return timings
+
+
+RUNNERS = {
+    'mixaudiobuffers': run_mixaudiobuffers,
+    'mixer': run_mixer,
+}
+
+
+def report(scenario, timings):
+    mean = timings.mean()
+    print '%s  | mean %8.1f us  p99 %8.1f us  max %8.1f us  | %5.1f%% of %.0f us' % (
+        scenario.label(), mean, numpy.percentile(timings, 99), timings.max(), 100 * mean / scenario.budget(), scenario.budget())
+    return mean
+
+
+def maxvoices(results, budget, frames):
+    """Least squares fit of callback cost = base + voices * pervoice, then how many voices fit in the budget."""
+    points = [(v, t) for (v, f), t in results.items() if f == frames]
+    if len(points) < 2:
+        return None
+    v, t = numpy.array(points, dtype=numpy.float64).T
+    pervoice, base = numpy.polyfit(v, t, 1)
+    if pervoice <= 0:
+        return None
+    return base, pervoice, int((budget - base) / pervoice)
+
+
+#########################################
+# MAIN
+#
+#########################################
+
+def intlist(s):
+    return [int(x) for x in s.split(',')]
+
+
+FORMATS = {'int16': numpy.int16, 'float32': numpy.float32}
+
+def formatlist(s):
+    formats = s.split(',')
+    for f in formats:
+        if f not in FORMATS:
+            raise argparse.ArgumentTypeError('unknown sample format %r (int16, float32)' % f)
+    return formats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline SamplerBox mixer benchmark (no sound card needed).')
+    parser.add_argument('--module', default='samplerbox_audio', help='audio engine module (samplerbox_audio or samplerbox_audio_neon)')
+    parser.add_argument('--runner', default='mixer', choices=sorted(RUNNERS.keys()))
+    parser.add_argument('--voices', type=intlist, default=[1, 8, 16, 32, 64, 80])
+    parser.add_argument('--frames', type=intlist, default=[128])
+    parser.add_argument('--pitch', default='mixed', choices=sorted(PITCHES.keys()) + ['all'])
+    parser.add_argument('--interpolation', default='linear', choices=['linear', 'cubic', 'sinc'], help='interpolation mode of the mixer runner')
+    parser.add_argument('--threads', type=int, default=1, help='mixing threads of the mixer runner')
+    parser.add_argument('--format', type=formatlist, default=['int16'], help='internal sample formats of the mixer runner, e.g. int16,float32')
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--quick', action='store_true', help='only looped/sustained voices, fewer iterations')
+    args = parser.parse_args()
+
+    if args.runner != 'mixer' and args.format != ['int16']:
+        parser.error('only the mixer runner supports float32 samples')
+    module = __import__(args.module)
+    runner = RUNNERS[args.runner]
+    pitches = sorted(PITCHES.keys()) if args.pitch == 'all' else [args.pitch]
+    iterations = min(args.iterations, 100) if args.quick else args.iterations
+    states = [(True, False)] if args.quick else [(True, False), (False, False), (True, True)]
+
+    print 'Engine: %s (%s, %s interpolation, %d threads), %d callbacks per scenario' % (args.module, args.runner, args.interpolation, args.threads, iterations)
+    summary = []
+    for format in args.format:
+        sounds = makesounds(FORMATS[format])
+        nbytes = sum(sound.data.nbytes for sound in sounds.values())
+        perminute = 60 * RATE * 2 * numpy.dtype(FORMATS[format]).itemsize / 1048576.0
+        print '\nSample format %s: %.1f MB of samples, %.1f MB per minute of stereo sample' % (format, nbytes / 1048576.0, perminute)
+        total = []
+        for looped, fadeout in states:
+            for pitch in pitches:
+                results = {}
+                for frames in args.frames:
+                    for voices in args.voices:
+                        scenario = Scenario(voices, frames, pitch, looped, fadeout, args.interpolation, args.threads)
+                        runner(module, scenario, sounds, 10)       # warm up
+                        results[voices, frames] = report(scenario, runner(module, scenario, sounds, iterations))
+                        total.append(results[voices, frames] / (voices * frames))
+                    fit = maxvoices(results, 1e6 * frames / RATE, frames)
+                    if fit:
+                        print '  => %d frames: %.1f us + %.2f us/voice, about %d voices fit in %.2f ms\n' % (
+                            frames, fit[0], fit[1], fit[2], frames * 1000.0 / RATE)
+        summary.append((format, perminute, 1.0 / numpy.mean(total)))    # us per voice-frame -> millions per second
+    if len(summary) > 1:
+        print 'Format    MB/min stereo   Mvoice-frames/s'
+        for format, perminute, throughput in summary:
+            print '%-8s  %13.1f   %15.1f' % (format, perminute, throughput)
+
+
+if __name__ == '__main__':
+    main()
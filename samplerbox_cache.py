@@ -0,0 +1,111 @@
+#
+#  SamplerBox
+#
+#  author:    Joseph Ernest (twitter: @JosephErnest, mail: contact@samplerbox.org)
+#  url:       http://www.samplerbox.org/
+#  license:   Creative Commons ShareAlike 3.0 (http://creativecommons.org/licenses/by-sa/3.0/)
+#
+#  samplerbox_cache.py: Sample and preset caches
+#
+#  Decoded samples are stored as .npy files (memory-mappable, the mixer plays them as they are)
+#  plus a small .json with the loop information. Entries are keyed by path, mtime and size of
+#  the WAV file, so an edited sample is simply decoded again. Copies rendered from a sample
+#  (octave-up versions) are stored the same way under a variant name.
+#
+#  Recently used presets are kept in memory (least recently used first out, within a byte budget),
+#  so switching back to a preset just reuses its Sound objects.
+#
+
+
+import os
+import collections
+import json
+import hashlib
+import thread
+import numpy
+
+
+class SampleCache:
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, filename, variant=''):
+        st = os.stat(filename)
+        key = hashlib.sha1('%s|%d|%d|%s' % (os.path.abspath(filename), int(st.st_mtime * 1000), st.st_size, variant)).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def load(self, filename, mmap=True, variant=''):
+        """Returns (data, info) for a cached sample or None. data is memory-mapped unless mmap is False.
+        variant names a version of the sample derived from the file (e.g. 'octave1'), '' is the sample itself."""
+        try:
+            path = self.path(filename, variant)
+            with open(path + '.json', 'r') as f:
+                info = json.load(f)
+            data = numpy.load(path + '.npy', mmap_mode='r' if mmap else None)
+        except (IOError, OSError, ValueError):
+            return None
+        return data, info
+
+    def store(self, filename, data, info, variant=''):
+        """Write a decoded sample. The .npy is renamed into place last: its presence means the entry is complete.
+        Each writer has its own temporary files (two loading threads may decode the same file), renames are atomic."""
+        try:
+            path = self.path(filename, variant)
+            tmp = '%s.%d.%d.tmp' % (path, os.getpid(), thread.get_ident())
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(info, f)
+                os.rename(tmp, path + '.json')
+                with open(tmp, 'wb') as f:
+                    numpy.save(f, numpy.ascontiguousarray(data))
+                os.rename(tmp, path + '.npy')
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        except (IOError, OSError):
+            pass        # read-only or full disk: the cache is only an optimisation
+
+
+class PresetCache:
+    """Least recently used presets kept in memory, within a budget of sample bytes."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = collections.OrderedDict()      # key -> (value, nbytes), most recently used last
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, nbytes):
+        old = self.entries.pop(key, None)
+        if old:
+            self.nbytes -= old[1]
+        if nbytes > self.budget:
+            return
+        while self.entries and self.nbytes + nbytes > self.budget:
+            self.nbytes -= self.entries.popitem(last=False)[1][1]
+        self.entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+
+    def recount(self, nbytes):
+        """The sizes of the entries have changed: nbytes(value) gives the new ones, the oldest entries are evicted to fit."""
+        for key, (value, old) in self.entries.items():
+            self.entries[key] = (value, nbytes(value))
+        self.nbytes = sum(size for value, size in self.entries.values())
+        while self.entries and self.nbytes > self.budget:
+            self.nbytes -= self.entries.popitem(last=False)[1][1]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'presets': len(self.entries), 'bytes': self.nbytes, 'budget': self.budget}
@@ -0,0 +1,140 @@
+#
+#  SamplerBox
+#
+#  author:    Joseph Ernest (twitter: @JosephErnest, mail: contact@samplerbox.org)
+#  url:       http://www.samplerbox.org/
+#  license:   Creative Commons ShareAlike 3.0 (http://creativecommons.org/licenses/by-sa/3.0/)
+#
+#  samplerbox_convert.pxi: Sample conversion kernels (Cython), included by samplerbox_audio.pyx and samplerbox_audio_neon.pyx
+#
+#  Plain loops over contiguous buffers (the compiler vectorizes them), run without the GIL so
+#  the loading threads decode in parallel, writing straight into the sample's final array.
+#  float32 samples keep the int16 scale: full scale is 32768.
+#
+
+
+ctypedef fused sample_t:
+    short
+    float
+
+
+cdef inline short saturate(float x) nogil:
+    if x >= 32767:
+        return 32767
+    if x <= -32768:
+        return -32768
+    return <short> x
+
+
+cdef void pcm24_to_int16(unsigned char *src, short *dst, Py_ssize_t n, int dither) nogil:
+    """Top 16 bits of each little-endian 24-bit sample, or rounded with TPDF dither of +-1 LSB."""
+    cdef Py_ssize_t i
+    cdef int x
+    cdef unsigned int seed = 1
+    if not dither:
+        for i in range(n):
+            dst[i] = <short> (src[3 * i + 1] | (src[3 * i + 2] << 8))
+        return
+    for i in range(n):
+        x = src[3 * i] | (src[3 * i + 1] << 8) | ((<signed char> src[3 * i + 2]) * 65536)
+        seed = seed * 1664525 + 1013904223       # LCG: two bytes of it make a triangular -255..255
+        x = (x + 128 + <int> ((seed >> 24) & 255) + <int> ((seed >> 16) & 255) - 255) >> 8
+        dst[i] = 32767 if x > 32767 else (-32768 if x < -32768 else x)
+
+
+cdef void pcm24_to_float32(unsigned char *src, float *dst, Py_ssize_t n) nogil:
+    cdef Py_ssize_t i
+    for i in range(n):
+        dst[i] = (src[3 * i] | (src[3 * i + 1] << 8) | ((<signed char> src[3 * i + 2]) * 65536)) * (1.0 / 256)
+
+
+cdef void pcm8_to(unsigned char *src, sample_t *dst, Py_ssize_t n) nogil:
+    cdef Py_ssize_t i
+    for i in range(n):
+        if sample_t is short:
+            dst[i] = <short> ((src[i] - 128) * 256)         # 8-bit WAV is unsigned
+        else:
+            dst[i] = (src[i] - 128) * 256.0
+
+
+cdef void float32_to_int16(float *src, short *dst, Py_ssize_t n) nogil:
+    cdef Py_ssize_t i
+    for i in range(n):
+        dst[i] = saturate(src[i] * 32768)
+
+
+cdef void mono_to_stereo(sample_t *src, sample_t *dst, Py_ssize_t n) nogil:
+    cdef Py_ssize_t i
+    for i in range(n):
+        dst[2 * i] = src[i]
+        dst[2 * i + 1] = src[i]
+
+
+cdef checkconversion(numpy.ndarray src, numpy.ndarray dst, Py_ssize_t n, Py_ssize_t m):
+    if not src.flags.c_contiguous or not dst.flags.c_contiguous or not dst.flags.writeable:
+        raise ValueError('conversion buffers must be C-contiguous, the destination writeable')
+    if src.nbytes < n or dst.size < m:
+        raise ValueError('conversion buffers too small')
+
+
+def convert24(numpy.ndarray src, numpy.ndarray dst, int dither=0):
+    """Little-endian 24-bit PCM bytes (uint8 array) -> dst, int16 (dither: TPDF instead of truncation) or float32."""
+    cdef Py_ssize_t n = src.nbytes // 3
+    checkconversion(src, dst, 3 * n, n)
+    cdef unsigned char *s = <unsigned char *> src.data
+    if dst.dtype == numpy.int16:
+        with nogil:
+            pcm24_to_int16(s, <short *> dst.data, n, dither)
+    elif dst.dtype == numpy.float32:
+        with nogil:
+            pcm24_to_float32(s, <float *> dst.data, n)
+    else:
+        raise ValueError('int16 or float32 destination only')
+
+
+def convert8(numpy.ndarray src, numpy.ndarray dst):
+    """Unsigned 8-bit PCM (uint8 array) -> dst, int16 or float32."""
+    cdef Py_ssize_t n = src.nbytes
+    checkconversion(src, dst, n, n)
+    cdef unsigned char *s = <unsigned char *> src.data
+    if dst.dtype == numpy.int16:
+        with nogil:
+            pcm8_to(s, <short *> dst.data, n)
+    elif dst.dtype == numpy.float32:
+        with nogil:
+            pcm8_to(s, <float *> dst.data, n)
+    else:
+        raise ValueError('int16 or float32 destination only')
+
+
+def convertfloat(numpy.ndarray src, numpy.ndarray dst):
+    """32-bit float samples (-1..1, float32 array) -> int16 dst, clipped."""
+    cdef Py_ssize_t n = src.size
+    if src.dtype != numpy.float32 or dst.dtype != numpy.int16:
+        raise ValueError('float32 source and int16 destination only')
+    checkconversion(src, dst, 4 * n, n)
+    with nogil:
+        float32_to_int16(<float *> src.data, <short *> dst.data, n)
+
+
+def interleave(numpy.ndarray src, numpy.ndarray dst):
+    """Mono src -> stereo interleaved dst of the same dtype (int16 or float32), twice as long."""
+    cdef Py_ssize_t n = src.size
+    if src.dtype != dst.dtype:
+        raise ValueError('same dtype only')
+    checkconversion(src, dst, src.nbytes, 2 * n)
+    if src.dtype == numpy.int16:
+        with nogil:
+            mono_to_stereo(<short *> src.data, <short *> dst.data, n)
+    elif src.dtype == numpy.float32:
+        with nogil:
+            mono_to_stereo(<float *> src.data, <float *> dst.data, n)
+    else:
+        raise ValueError('int16 or float32 only')
+
+
+def binary24_to_int16(char *data, int length):
+    res = numpy.empty(length, numpy.int16)
+    with nogil:         # samples are decoded by several loading threads at once
+        pcm24_to_int16(<unsigned char *> data, <short *> ((<numpy.ndarray> res).data), length, 0)
+    return res
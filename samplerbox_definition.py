@@ -0,0 +1,146 @@
+#
+#  SamplerBox
+#
+#  author:    Joseph Ernest (twitter: @JosephErnest, mail: contact@samplerbox.org)
+#  url:       http://www.samplerbox.org/
+#  license:   Creative Commons ShareAlike 3.0 (http://creativecommons.org/licenses/by-sa/3.0/)
+#
+#  samplerbox_definition.py: definition.txt compiler
+#
+#  A definition file is parsed once into its %%global parameters and one rule per sample
+#  line. All the rules are merged into a combined regex (each rule is an optional lookahead
+#  at the start of the file name, followed by an empty marker group), so one match per file
+#  finds every rule that matches it, exactly as if each rule had been tried on its own.
+#  Only the matching rules are then run on their own to read their %parameters. Compiled
+#  definitions are kept until the file's mtime changes, and the last directory listing's
+#  matches with them.
+#
+
+
+import os
+import re
+
+NOTES = ["c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b"]
+
+PARAMETERS = [('midinote', r'\d+'), ('velocity', r'\d+'), ('samplegain', r'\d+'), ('doublenote', r'\d+'),
+              ('notename', r'[A-Ga-g]#?[0-9]'), ('roundrobin', r'\d+')]
+DEFAULTS = {'midinote': '0', 'velocity': '127', 'samplegain': '100', 'doublenote': '0', 'notename': '', 'roundrobin': '0', 'bus': '0'}
+ENVELOPE = ['attack', 'decay', 'sustain', 'release']      # %%parameters of the envelope
+MAXGROUPS = 99         # Python 2's re supports 100 groups per regex: one combined regex per 99 rules
+
+
+class Definition:
+
+    def __init__(self, filename):
+        self.volume = 1.0                   # factor applied to the global volume (%%volume, in dB)
+        self.transpose = None               # %%transpose, None if not set
+        self.velocitysensitivity = None     # %%velocitysensitivity, None if not set
+        self.velocitycurve = None           # %%velocitycurve, exponent of the velocity response (1 = linear)
+        self.envelope = {}                  # %%attack, %%decay, %%release (ms) and %%sustain (dB) that are set
+        self.rules = []                     # (line number, regex, default parameters)
+        self.compiled = {}                  # rule index -> its own compiled regex, for the rules that matched a file
+        self.errors = []                    # line numbers that could not be parsed
+        self.lastfnames = None
+        self.lasthits = None
+        with open(filename, 'r') as definitionfile:
+            for i, pattern in enumerate(definitionfile):
+                try:
+                    self.parse(i + 1, pattern)
+                except:
+                    self.errors.append(i + 1)
+        self.matchers = []                  # (combined regex, index of its first rule)
+        for first in range(0, len(self.rules), MAXGROUPS):
+            self.matchers.append((re.compile(''.join('(?:(?=%s()))?' % re.sub(r'\(\?P<\w+>', '(?:', rule[1])
+                                                     for rule in self.rules[first:first + MAXGROUPS])), first))
+
+    def parse(self, line, pattern):
+        if r'%%volume' in pattern:        # %%paramaters are global parameters
+            self.volume *= 10 ** (float(pattern.split('=')[1].strip()) / 20)
+            return
+        if r'%%transpose' in pattern:
+            self.transpose = int(pattern.split('=')[1].strip())
+            return
+        if r'%%velocitysensitivity' in pattern:
+            self.velocitysensitivity = float(pattern.split('=')[1].strip())
+            return
+        if r'%%velocitycurve' in pattern:
+            curve = float(pattern.split('=')[1].strip())
+            if not curve > 0:
+                raise ValueError('velocitycurve must be more than 0')     # 0 ** curve at velocity 0
+            self.velocitycurve = curve
+            return
+        for name in ENVELOPE:
+            if r'%%' + name in pattern:
+                value = float(pattern.split('=')[1].strip())
+                if name != 'sustain' and not value >= 0:
+                    raise ValueError(name + ' must be 0 or more')           # times in ms, sustain is in dB
+                self.envelope[name] = value
+                return
+        if not pattern.strip():
+            return
+        defaults = dict(DEFAULTS)
+        if len(pattern.split(',')) > 1:
+            defaults.update(dict([item.split('=') for item in pattern.split(',', 1)[1].replace(' ', '').replace('%', '').split(',')]))
+        if int(defaults['bus']) < 0:
+            raise ValueError('bus must be 0 or more')     # bigger than the last card is clamped to it when loading
+        regex = re.escape(pattern.split(',')[0].strip())
+        for name, value in PARAMETERS:
+            if regex.count('\\%' + name) > 1:
+                raise ValueError('%' + name + ' twice')
+            regex = regex.replace('\\%' + name, '(?P<%s>%s)' % (name, value))
+        regex = regex.replace(r"\*", r".*?")    # .*? => non greedy
+        self.rules.append((line, regex, defaults))
+
+    def match(self, fnames):
+        """Returns (hits, errors): hits are (line, fname, midinote, velocity, roundrobin, samplegain, doublenote, bus)
+        for every rule matching every file, by line then in the order of fnames (when several hits have the same
+        key, the last one is meant to win); errors are the lines whose parameters could not be converted."""
+        if fnames == self.lastfnames:
+            return self.lasthits
+        found = []
+        for f, fname in enumerate(fnames):
+            for matcher, first in self.matchers:
+                markers = matcher.match(fname).groups()     # '' for the rules that match, None for the others
+                r = -1
+                for n in range(markers.count('')):
+                    r = markers.index('', r + 1)
+                    found.append((first + r, f))
+        found.sort()
+        hits, errors = [], []
+        for r, f in found:
+            line, regex, defaults = self.rules[r]
+            if r not in self.compiled:
+                self.compiled[r] = re.compile(regex)
+            info = self.compiled[r].match(fnames[f]).groupdict()
+            try:
+                midinote = int(info.get('midinote', defaults['midinote']))
+                velocity = int(info.get('velocity', defaults['velocity']))
+                samplegain = float(info.get('samplegain', defaults['samplegain'])) / 100
+                doublenote = int(info.get('doublenote', defaults['doublenote']))
+                notename = info.get('notename', defaults['notename'])
+                roundrobin = int(info.get('roundrobin', defaults['roundrobin']))
+                if notename:
+                    midinote = NOTES.index(notename[:-1].lower()) + (int(notename[-1]) + 2) * 12
+                hits.append((line, fnames[f], midinote, velocity, roundrobin, samplegain, doublenote, int(defaults['bus'])))
+            except:
+                if line not in errors:
+                    errors.append(line)
+        self.lastfnames, self.lasthits = list(fnames), (hits, errors)
+        return hits, errors
+
+
+definitions = {}        # filename -> ((mtime, size), Definition)
+
+def load(filename):
+    """The compiled definition file, or None if there is none. Recompiled only when the file changes."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    version = (st.st_mtime, st.st_size)
+    cached = definitions.get(filename)
+    if cached and cached[0] == version:
+        return cached[1]
+    definition = Definition(filename)
+    definitions[filename] = (version, definition)
+    return definition
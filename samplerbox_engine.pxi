@@ -0,0 +1,1023 @@
+#
+#  SamplerBox
+#
+#  author:    Joseph Ernest (twitter: @JosephErnest, mail: contact@samplerbox.org)
+#  url:       http://www.samplerbox.org/
+#  license:   Creative Commons ShareAlike 3.0 (http://creativecommons.org/licenses/by-sa/3.0/)
+#
+#  samplerbox_engine.pxi: Voice engine (Cython), included by samplerbox_audio.pyx and samplerbox_audio_neon.pyx
+#
+#  Voice state lives in C arrays (struct-of-arrays) indexed by voice number, so mixing
+#  runs without touching Python objects and without the GIL, into preallocated buffers.
+#
+#  Only the audio thread touches voice state. The MIDI thread talks to it through a
+#  single-producer / single-consumer ring of timestamped events, drained at the start
+#  of each mix(). Note-ons start at their exact frame inside the buffer.
+#
+#  Samples are int16, or float32 in the same scale (24-bit and float sources kept at full
+#  precision). The mixing kernels are fused-type functions compiled for both.
+#
+#  Each voice is routed to an output bus (one per sound card). All buses are rendered
+#  in the same pass into one buffer, bus after bus.
+#
+#  Each voice follows an ADSR envelope, precomputed per preset into tables of one gain per
+#  ENVBLOCK frames (see Envelope). The mixing kernels walk the table themselves, one call per
+#  voice and buffer: while the envelope moves, each table entry is a linear gain ramp (a carried
+#  add per frame, the slope changes every ENVBLOCK frames), so the gain of a frame does not
+#  depend on the buffer size; once sustained, the voice is mixed with a constant gain.
+#
+#  Keymap is the note/velocity -> sample table looked up by the MIDI thread at each note-on.
+#
+#  The audio thread counts what it does (mix durations, active voices, note-on latency) in
+#  plain C counters and log2 histograms, read from another thread by Mixer.stats().
+#
+
+
+from libc.stdlib cimport malloc, calloc, free
+from libc.string cimport memset
+from cython.parallel cimport prange
+from libc.math cimport fabs
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+import bisect
+
+# Voice stealing policies, used when a note starts and all the voices of its bus are busy
+cdef enum:
+    STEAL_OLDEST = 0       # the voice that started first (what playingsounds[-MAX_POLYPHONY:] used to do)
+    STEAL_QUIETEST = 1     # the voice with the lowest current gain (velocity x envelope)
+    STEAL_SAMENOTE = 2     # the oldest voice playing the same note, else the oldest voice
+STEALING = {'oldest': STEAL_OLDEST, 'quietest': STEAL_QUIETEST, 'samenote': STEAL_SAMENOTE}
+
+# Event types
+cdef enum:
+    EV_NOTEON = 0
+    EV_FADEOUT = 1
+    EV_STOP = 2
+    EV_FADEOUTALL = 3
+
+DEF QUEUESIZE = 256        # events, must be a power of two
+DEF PARALLELVOICES = 16    # with several mixing threads, fewer active voices than this are still mixed by one thread
+DEF HISTBINS = 24          # log2 histograms of durations, up to 2^24 us
+DEF ENVBLOCK = 32          # frames per envelope table entry, the gain is linear from one entry to the next
+
+# Master limiter: the output is delayed by LIMITERLOOKAHEAD frames, so the gain is already down when a peak comes out
+DEF LIMITERLOOKAHEAD = 32  # 0.7 ms at 44.1 kHz
+DEF LIMITERTHRESHOLD = 30000.0     # about -0.8 dBFS
+DEF LIMITERATTACK = 0.145          # 1 - exp(-5 / LIMITERLOOKAHEAD): within 1% of the target gain when the peak comes out
+DEF LIMITERRELEASE = 0.0005        # back up with a time constant of about 45 ms
+
+# Interpolation modes, cost per voice and per frame (see README)
+cdef enum:
+    INTERP_LINEAR = 0      # 2 samples, aliases on transposed notes
+    INTERP_CUBIC = 1       # 4 samples, cubic Hermite (Catmull-Rom), smoother highs, still aliases upwards
+    INTERP_SINC = 2        # SINCTAPS samples, Kaiser-windowed sinc, low-passed below the new Nyquist when pitched up
+INTERPOLATIONS = {'linear': INTERP_LINEAR, 'cubic': INTERP_CUBIC, 'sinc': INTERP_SINC}
+
+DEF SINCTAPS = 16          # filter length, the fetched frames are k-7 .. k+8
+DEF SINCPHASES = 128       # fractional positions, the nearest one is used
+DEF SINCBANDS = 9          # one cutoff per quarter octave of speed, up to 4 (faster voices use the last one)
+
+
+def sinctables(beta=8.0, rolloff=0.9):
+    """Polyphase windowed-sinc coefficients, float32 [SINCBANDS][SINCPHASES][SINCTAPS]. Each row sums to 1.
+    Band 0 (speed <= 1) is not low-passed, so unpitched notes play bit-exact."""
+    bands = []
+    for b in range(SINCBANDS):
+        cutoff = rolloff / 2 ** (b / 4.0) if b else 1.0
+        x = numpy.arange(SINCTAPS)[None, :] - (SINCTAPS // 2 - 1) - numpy.arange(SINCPHASES)[:, None] / float(SINCPHASES)
+        window = numpy.i0(beta * numpy.sqrt(numpy.clip(1 - (x / (SINCTAPS / 2.0)) ** 2, 0, 1))) / numpy.i0(beta)
+        h = cutoff * numpy.sinc(cutoff * x) * window
+        bands.append(h / h.sum(axis=1)[:, None])
+    return numpy.array(bands, numpy.float32)
+
+
+cdef inline int clampframe(int k, int last) nogil:
+    if k < 0:
+        return 0
+    if k > last:
+        return last
+    return k
+
+
+@cython.cdivision(True)
+cdef inline float hermite(sample_t *zz, int k, float j, int ch, int c, int last) nogil:
+    """Cubic Hermite interpolation of channel c between frames k and k+1, frames outside the sample are clamped."""
+    cdef float xm1, x0, x1, x2, c1, c2, c3
+    if k >= 1 and k + 2 <= last:
+        zz += ch * k + c
+        xm1 = zz[-ch]
+        x0 = zz[0]
+        x1 = zz[ch]
+        x2 = zz[2 * ch]
+    else:
+        xm1 = zz[ch * clampframe(k - 1, last) + c]
+        x0 = zz[ch * k + c]
+        x1 = zz[ch * clampframe(k + 1, last) + c]
+        x2 = zz[ch * clampframe(k + 2, last) + c]
+    c1 = 0.5 * (x1 - xm1)
+    c2 = xm1 - 2.5 * x0 + 2 * x1 - 0.5 * x2
+    c3 = 0.5 * (x2 - xm1) + 1.5 * (x0 - x1)
+    return ((c3 * j + c2) * j + c1) * j + x0
+
+
+@cython.boundscheck(False)
+cdef int mixstride(float *bb, sample_t *zz, int first, int N, int k, int step, int ch, int length, int loop,
+                   float velocity, float *env, int envlength, int clock) nogil:
+    """Integer speed from a whole frame (drum hits at their root note, octaves up): every step-th frame is
+    multiplied-accumulated as it is, no interpolation. Runs between loop wraps and envelope table entries are
+    plain strided loops the compiler can vectorize. Frame `first` is at frame `clock` of the envelope env
+    (see mixsamples). Returns the next frame to read."""
+    cdef int i = first, t, end, l, r, d = ch * step
+    cdef float gain, dgain, multiplier
+    while i < N:
+        if k > length - 2:
+            k = loop + 1
+        end = i + (length - 2 - k) // step + 1      # frames until the loop wraps
+        if end <= i:
+            end = i + 1
+        if end > N:
+            end = N
+        end = i + envchunk(velocity, env, envlength, clock + i - first, end - i, &gain, &dgain)
+        l = ch * k                  # left and right sample of frame k, the same one for mono
+        r = l + ch - 1
+        if dgain != 0:
+            multiplier = gain
+            for t in range(i, end):
+                bb[2 * t] += zz[l] * multiplier
+                bb[2 * t + 1] += zz[r] * multiplier
+                multiplier += dgain
+                l += d
+                r += d
+        else:
+            for t in range(i, end):
+                bb[2 * t] += zz[l] * gain
+                bb[2 * t + 1] += zz[r] * gain
+                l += d
+                r += d
+        k += (end - i) * step
+        i = end
+    return k
+
+
+cdef inline float sinc(sample_t *zz, int k, float *h, int ch, int c, int last) nogil:
+    """Polyphase FIR of channel c around frame k with the coefficients h, frames outside the sample are clamped."""
+    cdef int t, start = k - (SINCTAPS // 2 - 1)
+    cdef float acc = 0
+    if start >= 0 and start + SINCTAPS - 1 <= last:
+        zz += ch * start + c
+        for t in range(SINCTAPS):
+            acc += zz[ch * t] * h[t]
+    else:
+        for t in range(SINCTAPS):
+            acc += zz[ch * clampframe(start + t, last) + c] * h[t]
+    return acc
+
+
+cdef inline double monotonic() nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+cdef class Histogram:
+    """Durations in log2 bins: bin i counts the values from 2^i to 2^(i+1) microseconds (bin 0 also the shorter ones).
+    Written by a single thread without lock (a few nanoseconds), snapshot() can be called from any thread."""
+    cdef long long bins[HISTBINS]
+    cdef readonly long long count
+    cdef readonly double total, peak
+
+    cdef inline void record(self, double seconds) nogil:
+        cdef int b = 0
+        cdef long long us = <long long> (seconds * 1e6)
+        while us > 1 and b < HISTBINS - 1:
+            us >>= 1
+            b += 1
+        self.bins[b] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.peak:
+            self.peak = seconds
+
+    def add(self, double seconds):
+        self.record(seconds)
+
+    def snapshot(self):
+        return {'count': self.count, 'mean_us': 1e6 * self.total / self.count if self.count else 0.0, 'max_us': 1e6 * self.peak,
+                'bins': [self.bins[b] for b in range(HISTBINS)]}
+
+
+cdef inline float tableat(float *table, int n, int t) nogil:
+    """Gain t frames into an envelope table of n entries, linear between entries, the last one held after the end."""
+    cdef int k = t // ENVBLOCK
+    if k >= n - 1:
+        return table[n - 1]
+    return table[k] + (table[k + 1] - table[k]) * (t - k * ENVBLOCK) * (1.0 / ENVBLOCK)
+
+
+@cython.cdivision(True)
+cdef inline int envchunk(float velocity, float *env, int n, int t, int frames, float *gain, float *dgain) nogil:
+    """The gain ramp of an envelope table of n entries from its frame t, scaled by velocity: sets its start gain and
+    slope per frame, returns the frames it lasts (to the next table entry, at most `frames`). Constant after the end."""
+    cdef int k = t // ENVBLOCK
+    cdef int left
+    if k >= n - 1:
+        gain[0] = velocity * env[n - 1]
+        dgain[0] = 0
+        return frames
+    dgain[0] = velocity * (env[k + 1] - env[k]) * (1.0 / ENVBLOCK)
+    gain[0] = velocity * env[k] + (t - k * ENVBLOCK) * dgain[0]
+    left = (k + 1) * ENVBLOCK - t
+    return left if left < frames else frames
+
+
+cdef class Envelope:
+    """ADSR envelope of a preset, computed once into two tables of one gain per ENVBLOCK frames: curve (linear
+    attack from 0 to 1, decay to the sustain level, then the sustain level held while the note is on) and release
+    (1 to 0 after the note-off, scaled by the gain the voice had). Times are in seconds. `releasetable`, one gain
+    per frame (e.g. FADEOUT), replaces the computed release."""
+    cdef readonly numpy.ndarray curve
+    cdef readonly numpy.ndarray release
+    cdef readonly double attack, decay, sustain, releasetime
+    cdef readonly int peak            # frames to the end of the attack, where the curve reaches 1
+
+    def __init__(self, double attack=0, double decay=0, double sustain=1.0, double release=0.68, int rate=44100,
+                 numpy.ndarray releasetable=None):
+        self.attack, self.decay, self.sustain, self.releasetime = attack, decay, sustain, release
+        a = numpy.arange(0, attack * rate, ENVBLOCK) / (attack * rate) if attack > 0 else []
+        x = numpy.arange(0, max(decay * rate, 1), ENVBLOCK) / max(decay * rate, 1)
+        d = sustain + (1 - sustain) * (1 - x) ** 3      # fast then slow, close to an exponential decay
+        self.curve = numpy.ascontiguousarray(numpy.concatenate([a, d, [sustain]]), numpy.float32)
+        self.peak = len(a) * ENVBLOCK
+        if releasetable is not None:
+            r = releasetable[::ENVBLOCK]
+        else:
+            x = numpy.arange(0, max(release * rate, 1), ENVBLOCK) / max(release * rate, 1)
+            r = (1 - x) ** 6                            # same shape as the FADEOUT table
+        self.release = numpy.ascontiguousarray(numpy.concatenate([r, [0]]), numpy.float32)
+
+    def duration(self):
+        """Frames until the curve reaches the sustain level, and until the release reaches 0."""
+        return (len(self.curve) - 1) * ENVBLOCK, (len(self.release) - 1) * ENVBLOCK
+
+
+cdef class Mixer:
+    cdef readonly int maxvoices, frames, rate
+    cdef readonly int busvoices       # voices of each bus (maxvoices / outputs): a bus never steals another bus's voice
+    cdef int allowed                  # effective polyphony of each bus, see voicelimit
+    cdef int *busactive               # active voices per bus
+    cdef public int stealing
+    cdef public int interpolation
+    cdef readonly int threads
+    cdef readonly int outputs         # number of output buses, mix() returns outputs x 2 x frames samples
+    cdef public int limiter           # 1 = soft look-ahead limiter on each bus before the int16 conversion
+    cdef readonly long long stolen    # voices stolen since the mixer was created
+    cdef readonly long long dropped   # events lost because the queue was full
+
+    # instrumentation, written by the audio thread only
+    cdef readonly long long mixes
+    cdef readonly Histogram mixtime           # duration of mix()
+    cdef readonly Histogram notelatency       # note-on event time -> its first frame in a mixed buffer
+    cdef long long *voicehist                 # mixes per number of active voices, maxvoices + 1 entries
+
+    # voice state, one entry per voice, only touched by the audio thread
+    cdef char *active
+    cdef char *isfadeout              # released: the voice follows its envelope's release table
+    cdef double *pos
+    cdef float *speed
+    cdef float *gain
+    cdef int *fadeoutpos              # frames since the note-off
+    cdef float *releaselevel          # envelope gain when the note was released
+    cdef int *envpos                  # frames since the note-on, up to the end of the envelope's curve
+    cdef float **envcurve             # the voice's envelope tables (see Envelope)
+    cdef int *envcurvelength
+    cdef float **envrelease
+    cdef int *envreleaselength
+    cdef int *loop
+    cdef int *length
+    cdef int *note
+    cdef int *startoffset             # frame inside the next buffer where the voice starts
+    cdef int *channels                # 2 = stereo interleaved, 1 = mono (read twice, no stereo copy needed)
+    cdef int *bus
+    cdef void **data                  # short * or float * samples
+    cdef void **headdata              # streamed samples: copy of the first headlength frames kept in RAM
+    cdef char *isfloat                # 1 = float32 samples, 0 = int16
+    cdef int *headlength
+    cdef long long *serial
+    cdef list arrays                  # keeps each voice's sample array alive while data[] points into it
+    cdef list heads
+    cdef list envelopes               # keeps each voice's Envelope alive while envcurve[] and envrelease[] point into it
+    cdef int *freelist                # stack of free voice numbers, so allocation and release are O(1)
+    cdef int nfree
+    cdef int *activelist              # voices to mix in this buffer
+    cdef char *ended                  # set by mixvoice, released after mixing (mixing threads must not touch freelist)
+
+    # event queue: the MIDI thread fills slot [tail] then moves tail, the audio thread reads from head
+    cdef char evtype[QUEUESIZE]
+    cdef double evtime[QUEUESIZE]
+    cdef long long evserial[QUEUESIZE]
+    cdef int evnote[QUEUESIZE]
+    cdef int evlength[QUEUESIZE]
+    cdef int evloop[QUEUESIZE]
+    cdef int evchannels[QUEUESIZE]
+    cdef int evbus[QUEUESIZE]
+    cdef char evfloat[QUEUESIZE]
+    cdef float evspeed[QUEUESIZE]
+    cdef float evgain[QUEUESIZE]
+    cdef list evarrays
+    cdef list evheads
+    cdef list evenvelopes
+    cdef unsigned int head, tail
+    cdef long long counter            # serial of the last note-on, producer side
+    cdef char stopallrequest          # may be set from any thread (preset loading)
+    cdef unsigned int stopuntil       # note-ons queued before the stopall request are dropped too
+    cdef double lastmixtime
+
+    cdef numpy.ndarray SINC
+    cdef float *sinctable
+    cdef readonly Envelope defaultenvelope    # for the note-ons without one: no attack, FADEOUT as release
+
+    cdef numpy.ndarray mixbuffer      # float32 accumulator
+    cdef numpy.ndarray threadbuffers  # one more accumulator per extra mixing thread
+    cdef numpy.ndarray outbuffer      # int16 output, returned by mix()
+    cdef readonly list outputbuffers  # views of outbuffer, one per bus, handed as they are to PortAudio (buffer protocol)
+
+    # limiter state, per bus
+    cdef float *limitdelay            # LIMITERLOOKAHEAD stereo frames
+    cdef int *limitpos
+    cdef float *limitgain             # gain applied to the frames coming out
+    cdef float *limittarget           # gain needed by each frame in the delay line
+    cdef float *limithold             # lowest of them
+    cdef int *limitholdcount          # frames until that one leaves the delay line
+
+    def __cinit__(self, int maxvoices, int frames, numpy.ndarray FADEOUT, int FADEOUTLENGTH, stealing='oldest', int rate=44100,
+                  interpolation='linear', int threads=1, int outputs=1, limiter=False):
+        cdef int v
+        self.maxvoices = maxvoices
+        self.rate = rate
+        self.active = <char *> calloc(maxvoices, sizeof(char))
+        self.isfadeout = <char *> calloc(maxvoices, sizeof(char))
+        self.pos = <double *> calloc(maxvoices, sizeof(double))
+        self.speed = <float *> calloc(maxvoices, sizeof(float))
+        self.gain = <float *> calloc(maxvoices, sizeof(float))
+        self.fadeoutpos = <int *> calloc(maxvoices, sizeof(int))
+        self.releaselevel = <float *> calloc(maxvoices, sizeof(float))
+        self.envpos = <int *> calloc(maxvoices, sizeof(int))
+        self.envcurve = <float **> calloc(maxvoices, sizeof(float *))
+        self.envcurvelength = <int *> calloc(maxvoices, sizeof(int))
+        self.envrelease = <float **> calloc(maxvoices, sizeof(float *))
+        self.envreleaselength = <int *> calloc(maxvoices, sizeof(int))
+        self.loop = <int *> calloc(maxvoices, sizeof(int))
+        self.length = <int *> calloc(maxvoices, sizeof(int))
+        self.note = <int *> calloc(maxvoices, sizeof(int))
+        self.startoffset = <int *> calloc(maxvoices, sizeof(int))
+        self.channels = <int *> calloc(maxvoices, sizeof(int))
+        self.bus = <int *> calloc(maxvoices, sizeof(int))
+        self.data = <void **> calloc(maxvoices, sizeof(void *))
+        self.headdata = <void **> calloc(maxvoices, sizeof(void *))
+        self.isfloat = <char *> calloc(maxvoices, sizeof(char))
+        self.headlength = <int *> calloc(maxvoices, sizeof(int))
+        self.serial = <long long *> calloc(maxvoices, sizeof(long long))
+        self.freelist = <int *> calloc(maxvoices, sizeof(int))
+        self.activelist = <int *> calloc(maxvoices, sizeof(int))
+        self.ended = <char *> calloc(maxvoices, sizeof(char))
+        self.voicehist = <long long *> calloc(maxvoices + 1, sizeof(long long))
+        if not (self.voicehist and self.active and self.isfadeout and self.pos and self.speed and self.gain and self.fadeoutpos and self.loop
+                and self.releaselevel and self.envpos and self.envcurve and self.envcurvelength and self.envrelease and self.envreleaselength
+                and self.length and self.note and self.startoffset and self.channels and self.bus and self.data and self.headdata and self.isfloat
+                and self.headlength and self.serial and self.freelist and self.activelist and self.ended):
+            raise MemoryError()
+        for v in range(maxvoices):
+            self.freelist[v] = maxvoices - 1 - v
+        self.nfree = maxvoices
+        self.arrays = [None] * maxvoices
+        self.heads = [None] * maxvoices
+        self.envelopes = [None] * maxvoices
+        self.evarrays = [None] * QUEUESIZE
+        self.evheads = [None] * QUEUESIZE
+        self.evenvelopes = [None] * QUEUESIZE
+        self.head = 0
+        self.tail = 0
+        self.counter = 0
+        self.stopallrequest = 0
+        self.stopuntil = 0
+        self.lastmixtime = 0
+        self.stealing = STEALING[stealing]
+        self.interpolation = INTERPOLATIONS[interpolation]
+        self.threads = max(1, threads)
+        self.outputs = max(1, outputs)
+        self.busvoices = max(1, maxvoices // self.outputs)
+        self.allowed = self.busvoices
+        self.busactive = <int *> calloc(self.outputs, sizeof(int))
+        if not self.busactive:
+            raise MemoryError()
+        self.limiter = 1 if limiter else 0
+        self.limitdelay = <float *> calloc(self.outputs * 2 * LIMITERLOOKAHEAD, sizeof(float))
+        self.limitpos = <int *> calloc(self.outputs, sizeof(int))
+        self.limitgain = <float *> calloc(self.outputs, sizeof(float))
+        self.limittarget = <float *> calloc(self.outputs * LIMITERLOOKAHEAD, sizeof(float))
+        self.limithold = <float *> calloc(self.outputs, sizeof(float))
+        self.limitholdcount = <int *> calloc(self.outputs, sizeof(int))
+        if not (self.limitdelay and self.limittarget and self.limitpos and self.limitgain and self.limithold and self.limitholdcount):
+            raise MemoryError()
+        for v in range(self.outputs):
+            self.limitgain[v] = 1
+            self.limithold[v] = 1
+            self.limitholdcount[v] = LIMITERLOOKAHEAD
+        for v in range(self.outputs * LIMITERLOOKAHEAD):
+            self.limittarget[v] = 1
+        self.SINC = sinctables()
+        self.sinctable = <float *> (self.SINC.data)
+        self.stolen = 0
+        self.dropped = 0
+        self.mixes = 0
+        self.mixtime = Histogram()
+        self.notelatency = Histogram()
+        self.defaultenvelope = Envelope(release=<double> FADEOUTLENGTH / rate, rate=rate, releasetable=FADEOUT[:FADEOUTLENGTH])
+        self.resize(frames)
+
+    def __dealloc__(self):
+        free(self.active)
+        free(self.isfadeout)
+        free(self.pos)
+        free(self.speed)
+        free(self.gain)
+        free(self.fadeoutpos)
+        free(self.releaselevel)
+        free(self.envpos)
+        free(self.envcurve)
+        free(self.envcurvelength)
+        free(self.envrelease)
+        free(self.envreleaselength)
+        free(self.loop)
+        free(self.length)
+        free(self.note)
+        free(self.startoffset)
+        free(self.channels)
+        free(self.bus)
+        free(self.data)
+        free(self.headdata)
+        free(self.isfloat)
+        free(self.headlength)
+        free(self.serial)
+        free(self.freelist)
+        free(self.activelist)
+        free(self.ended)
+        free(self.voicehist)
+        free(self.limitdelay)
+        free(self.busactive)
+        free(self.limitpos)
+        free(self.limitgain)
+        free(self.limittarget)
+        free(self.limithold)
+        free(self.limitholdcount)
+
+    property voicelimit:
+        """Effective polyphony of each bus (1..busvoices): beyond it a note-on steals a voice of its bus even if there
+        are free ones. Lowering it lets a latency controller shed load before the callback misses its deadline."""
+        def __get__(self):
+            return self.allowed
+
+        def __set__(self, int n):
+            self.allowed = min(max(n, 1), self.busvoices)
+
+    def resize(self, int frames):
+        self.frames = frames
+        self.mixbuffer = numpy.zeros(self.outputs * 2 * frames, numpy.float32)
+        self.threadbuffers = numpy.zeros((self.threads - 1) * self.outputs * 2 * frames + 1, numpy.float32)
+        self.outbuffer = numpy.zeros(self.outputs * 2 * frames, numpy.int16)
+        self.outputbuffers = [self.outbuffer[bus * 2 * frames:(bus + 1) * 2 * frames] for bus in range(self.outputs)]
+
+    #########################################
+    # PRODUCER SIDE (MIDI THREAD)
+    #########################################
+
+    cdef int push(self, char evtype, long long serial, double time):
+        """Fill the common fields of the next event, returns its slot or -1 if the queue is full.
+        The event is only seen by the audio thread once the caller moves tail."""
+        cdef unsigned int slot = self.tail
+        if slot - self.head >= QUEUESIZE:
+            self.dropped += 1
+            return -1
+        slot &= QUEUESIZE - 1
+        self.evtype[slot] = evtype
+        self.evserial[slot] = serial
+        self.evtime[slot] = time
+        return slot
+
+    def noteon(self, numpy.ndarray data, int nframes, int loop, float speed, float gain, int note=-1, double time=0, int channels=2,
+               numpy.ndarray head=None, int bus=0, Envelope envelope=None):
+        """Queue a voice playing `data` (int16 or float32 in int16 scale, stereo interleaved or mono) on output `bus`,
+        starting at `time` (time.time() clock, 0 = start of the next buffer). Returns the note's serial number, used to
+        fade it out or stop it. `head` is an optional in-RAM copy of the beginning of `data`, used while the voice plays that part.
+        `envelope` defaults to defaultenvelope."""
+        cdef int slot
+        if (data.dtype != numpy.int16 and data.dtype != numpy.float32) or not data.flags.c_contiguous:
+            raise ValueError('sample data must be C-contiguous int16 or float32')
+        if head is not None and (head.dtype != data.dtype or not head.flags.c_contiguous):
+            raise ValueError('sample head must be C-contiguous, of the same type as the data')
+        if channels != 1 and channels != 2:
+            raise ValueError('only mono and stereo samples are supported')
+        if bus < 0 or bus >= self.outputs:
+            raise ValueError('no output bus %d' % bus)
+        slot = self.push(EV_NOTEON, self.counter + 1, time)
+        if slot == -1:
+            return 0
+        self.counter += 1
+        self.evarrays[slot] = data
+        self.evheads[slot] = head
+        self.evenvelopes[slot] = envelope if envelope is not None else self.defaultenvelope
+        self.evlength[slot] = nframes
+        self.evloop[slot] = loop
+        self.evspeed[slot] = speed
+        self.evgain[slot] = gain
+        self.evnote[slot] = note
+        self.evchannels[slot] = channels
+        self.evbus[slot] = bus
+        self.evfloat[slot] = data.dtype == numpy.float32
+        self.tail += 1          # publish
+        return self.counter
+
+    def fadeout(self, long long serial):
+        if self.push(EV_FADEOUT, serial, 0) != -1:
+            self.tail += 1
+
+    def stop(self, long long serial):
+        if self.push(EV_STOP, serial, 0) != -1:
+            self.tail += 1
+
+    def fadeoutall(self):
+        if self.push(EV_FADEOUTALL, 0, 0) != -1:
+            self.tail += 1
+
+    def stopall(self):
+        """Silence all voices and the notes already queued at the next buffer, can be called from any thread."""
+        self.stopuntil = self.tail
+        self.stopallrequest = 1
+
+    #########################################
+    # CONSUMER SIDE (AUDIO THREAD)
+    #########################################
+
+    cdef void release(self, int v) nogil:
+        if self.active[v]:
+            self.active[v] = 0
+            self.busactive[self.bus[v]] -= 1
+            self.freelist[self.nfree] = v
+            self.nfree += 1
+
+    cdef float envelopegain(self, int v) nogil:
+        """Envelope gain of voice v at the start of the next buffer."""
+        if self.isfadeout[v]:
+            return self.releaselevel[v] * tableat(self.envrelease[v], self.envreleaselength[v], self.fadeoutpos[v])
+        return tableat(self.envcurve[v], self.envcurvelength[v], self.envpos[v])
+
+    cdef void noteoff(self, int v) nogil:
+        """Start the release of voice v from the gain it has reached."""
+        if not self.isfadeout[v]:
+            self.releaselevel[v] = self.envelopegain(v)
+            self.fadeoutpos[v] = 0
+            self.isfadeout[v] = 1
+
+    cdef float currentgain(self, int v) nogil:
+        return self.gain[v] * self.envelopegain(v)
+
+    cdef int steal(self, int note, int bus) nogil:
+        """All voices allowed on the bus are busy: pick one of them according to the stealing policy."""
+        cdef int v, best = -1
+        self.stolen += 1
+        if self.stealing == STEAL_SAMENOTE:
+            for v in range(self.maxvoices):
+                if self.active[v] and self.bus[v] == bus and self.note[v] == note and (best == -1 or self.serial[v] < self.serial[best]):
+                    best = v
+            if best != -1:
+                return best
+        for v in range(self.maxvoices):
+            if not self.active[v] or self.bus[v] != bus:
+                continue
+            if best == -1:
+                best = v
+            elif self.stealing == STEAL_QUIETEST:
+                if self.currentgain(v) < self.currentgain(best):
+                    best = v
+            elif self.serial[v] < self.serial[best]:
+                best = v
+        return best
+
+    cdef int allocate(self, int note, int bus) nogil:
+        """A voice for a note on the bus, counted on it. The buses together never allow more than maxvoices."""
+        if self.busactive[bus] < self.allowed:
+            self.busactive[bus] += 1
+            self.nfree -= 1
+            return self.freelist[self.nfree]
+        return self.steal(note, bus)
+
+    cdef int find(self, long long serial) nogil:
+        cdef int v
+        for v in range(self.maxvoices):
+            if self.active[v] and self.serial[v] == serial:
+                return v
+        return -1
+
+    @cython.cdivision(True)
+    cdef void drain(self, int frame_count, double now):
+        """Apply queued events. A note-on keeps the position it arrived at inside the previous
+        buffer period: constant latency of one buffer instead of up to one buffer of jitter."""
+        cdef unsigned int slot
+        cdef int v, offset
+        cdef Envelope envelope
+        cdef double period = <double> frame_count / self.rate
+        cdef char stopping = self.stopallrequest
+        if stopping:
+            for v in range(self.maxvoices):
+                self.release(v)
+        while self.head != self.tail:
+            slot = self.head & (QUEUESIZE - 1)
+            if stopping and <int> (self.stopuntil - self.head) > 0:
+                self.evarrays[slot] = None
+                self.evheads[slot] = None
+                self.evenvelopes[slot] = None
+            elif self.evtype[slot] == EV_NOTEON:
+                offset = 0
+                if now > 0 and self.evtime[slot] > 0 and now - self.lastmixtime < 2 * period:
+                    offset = <int> ((self.evtime[slot] - self.lastmixtime) * self.rate)
+                    if offset < 0:
+                        offset = 0
+                    elif offset >= frame_count:
+                        offset = frame_count - 1
+                    self.notelatency.record(now + <double> offset / self.rate - self.evtime[slot])
+                v = self.allocate(self.evnote[slot], self.evbus[slot])
+                self.arrays[v] = self.evarrays[slot]
+                self.evarrays[slot] = None
+                self.data[v] = <void *> ((<numpy.ndarray> self.arrays[v]).data)
+                self.isfloat[v] = self.evfloat[slot]
+                self.heads[v] = self.evheads[slot]
+                self.evheads[slot] = None
+                if self.heads[v] is None:
+                    self.headlength[v] = 0
+                else:
+                    self.headdata[v] = <void *> ((<numpy.ndarray> self.heads[v]).data)
+                    self.headlength[v] = len(self.heads[v]) // self.evchannels[slot]
+                self.length[v] = self.evlength[slot]
+                self.loop[v] = self.evloop[slot]
+                self.speed[v] = self.evspeed[slot]
+                self.gain[v] = self.evgain[slot]
+                self.note[v] = self.evnote[slot]
+                self.channels[v] = self.evchannels[slot]
+                self.bus[v] = self.evbus[slot]
+                self.serial[v] = self.evserial[slot]
+                self.startoffset[v] = offset
+                self.pos[v] = 0
+                envelope = self.evenvelopes[slot]
+                self.evenvelopes[slot] = None
+                self.envelopes[v] = envelope
+                self.envcurve[v] = <float *> (envelope.curve.data)
+                self.envcurvelength[v] = len(envelope.curve)
+                self.envrelease[v] = <float *> (envelope.release.data)
+                self.envreleaselength[v] = len(envelope.release)
+                self.envpos[v] = 0
+                self.fadeoutpos[v] = 0
+                self.isfadeout[v] = 0
+                self.active[v] = 1
+            elif self.evtype[slot] == EV_FADEOUTALL:
+                for v in range(self.maxvoices):
+                    if self.active[v]:
+                        self.noteoff(v)
+            else:
+                v = self.find(self.evserial[slot])
+                if v != -1:
+                    if self.evtype[slot] == EV_FADEOUT:
+                        self.noteoff(v)
+                    else:
+                        self.release(v)
+            self.head += 1
+        if stopping:
+            self.stopallrequest = 0
+        if now > 0:
+            self.lastmixtime = now
+
+    def streamingvoices(self):
+        """(sample array, current frame, channels) for each playing voice that has a head, i.e. streams from disk."""
+        cdef int v
+        return [(self.arrays[v], <int> self.pos[v], self.channels[v]) for v in range(self.maxvoices)
+                if self.active[v] and self.headlength[v] > 0]
+
+    def isplaying(self, long long serial):
+        return self.find(serial) != -1
+
+    def activecount(self):
+        cdef int v, n = 0
+        for v in range(self.maxvoices):
+            n += self.active[v]
+        return n
+
+    def stats(self):
+        """Counters and histograms of the audio thread since the mixer was created."""
+        return {'mixes': self.mixes, 'stolen': self.stolen, 'dropped': self.dropped, 'voicelimit': self.allowed,
+                'mixtime': self.mixtime.snapshot(), 'notelatency': self.notelatency.snapshot(),
+                'voices': [self.voicehist[n] for n in range(self.maxvoices + 1)]}
+
+    def mix(self, int frame_count, double GLOBALVOLUME, double now=0):
+        """Mix all active voices, returns the preallocated int16 output buffer (valid until the next call):
+        outputs x 2 x frame_count samples, the interleaved stereo buffer of bus 0 first, then bus 1...
+        `now` is time.time() at the start of the callback, used to place note-ons inside the buffer."""
+        cdef double start = monotonic()
+        cdef int v, i, n, t, nactive = 0
+        cdef int size = self.outputs * 2 * frame_count
+        if frame_count != self.frames:
+            self.resize(frame_count)
+        cdef float *bb = <float *> (self.mixbuffer.data)
+        cdef float *tb = <float *> (self.threadbuffers.data)
+        cdef short *ob = <short *> (self.outbuffer.data)
+        cdef float volume = GLOBALVOLUME
+        self.drain(frame_count, now)
+        with nogil:
+            memset(bb, 0, size * sizeof(float))
+            for v in range(self.maxvoices):
+                if self.active[v]:
+                    self.activelist[nactive] = v
+                    nactive += 1
+            if self.threads > 1 and nactive >= PARALLELVOICES:
+                # each thread mixes every threads-th active voice into its own buffer, thread 0 into bb
+                for t in prange(self.threads, num_threads=self.threads, schedule='static', chunksize=1):
+                    self.mixpart(t, nactive, bb if t == 0 else tb + (t - 1) * size, frame_count, volume)
+                for t in range(self.threads - 1):
+                    for i in range(size):
+                        bb[i] += tb[t * size + i]
+            else:
+                for n in range(nactive):
+                    v = self.activelist[n]
+                    self.ended[v] = self.mixvoice(v, bb + self.bus[v] * 2 * frame_count, frame_count, volume)
+            for n in range(nactive):
+                if self.ended[self.activelist[n]]:
+                    self.release(self.activelist[n])
+            if self.limiter:
+                for t in range(self.outputs):
+                    self.limit(bb + t * 2 * frame_count, frame_count, t)
+            for i in range(size):         # saturating conversion: loud peaks clip instead of wrapping around
+                if bb[i] >= 32767:
+                    ob[i] = 32767
+                elif bb[i] <= -32768:
+                    ob[i] = -32768
+                else:
+                    ob[i] = <short> bb[i]
+            self.voicehist[nactive] += 1
+            self.mixes += 1
+            self.mixtime.record(monotonic() - start)
+        return self.outbuffer
+
+    @cython.cdivision(True)
+    cdef void limit(self, float *bb, int frame_count, int bus) nogil:
+        """Soft look-ahead limiter, in place: each frame comes out LIMITERLOOKAHEAD frames later, scaled by a
+        gain that glides down ahead of the peaks above LIMITERTHRESHOLD and slowly back up after them."""
+        cdef float *delay = self.limitdelay + bus * 2 * LIMITERLOOKAHEAD
+        cdef float *targets = self.limittarget + bus * LIMITERLOOKAHEAD
+        cdef int i, j, d = self.limitpos[bus], holdcount = self.limitholdcount[bus]
+        cdef float g = self.limitgain[bus], hold = self.limithold[bus]
+        cdef float l, r, peak, target
+        for i in range(frame_count):
+            l = bb[2 * i]
+            r = bb[2 * i + 1]
+            peak = fabs(l) if fabs(l) > fabs(r) else fabs(r)
+            target = LIMITERTHRESHOLD / peak if peak > LIMITERTHRESHOLD else 1
+            holdcount -= 1
+            targets[d] = target             # slot d: the frame coming out now is replaced by this one
+            if target <= hold:              # hold the lowest gain until that frame has come out
+                hold = target
+                holdcount = LIMITERLOOKAHEAD
+            elif holdcount <= 0:            # it has: the lowest gain of the frames still in the delay line
+                hold = target
+                holdcount = LIMITERLOOKAHEAD
+                for j in range(LIMITERLOOKAHEAD - 1, 0, -1):    # slot d + j comes out in j frames, ties keep the latest
+                    if targets[(d + j) % LIMITERLOOKAHEAD] < hold:
+                        hold = targets[(d + j) % LIMITERLOOKAHEAD]
+                        holdcount = j
+            g += (hold - g) * (LIMITERATTACK if hold < g else LIMITERRELEASE)
+            if g < hold and g > hold - 1e-4:    # the release step gets below float32 resolution near 1: snap
+                g = hold
+            bb[2 * i] = delay[2 * d] * g
+            bb[2 * i + 1] = delay[2 * d + 1] * g
+            delay[2 * d] = l
+            delay[2 * d + 1] = r
+            d += 1
+            if d == LIMITERLOOKAHEAD:
+                d = 0
+        self.limitpos[bus] = d
+        self.limitgain[bus] = g
+        self.limithold[bus] = hold
+        self.limitholdcount[bus] = holdcount
+
+    cdef void mixpart(self, int t, int nactive, float *bb, int frame_count, float volume) nogil:
+        cdef int n = t, v
+        memset(bb, 0, self.outputs * 2 * frame_count * sizeof(float))
+        while n < nactive:
+            v = self.activelist[n]
+            self.ended[v] = self.mixvoice(v, bb + self.bus[v] * 2 * frame_count, frame_count, volume)
+            n += self.threads
+
+    @cython.cdivision(True)
+    cdef char mixvoice(self, int v, float *bb, int frame_count, float volume) nogil:
+        """Mix voice v into bb, returns 1 when the voice has ended. Only touches voice v's state."""
+        cdef int N = frame_count
+        cdef int first = self.startoffset[v]
+        cdef int length = self.length[v]
+        cdef double pos = self.pos[v]
+        cdef float speed = self.speed[v]
+        cdef void *zz = self.data[v]
+        cdef float *table = NULL
+        cdef int band = 0
+        cdef char ended = 0
+        cdef float bandspeed = 1
+        cdef float *env = self.envcurve[v]
+        cdef int envlength = self.envcurvelength[v]
+        cdef int clock = self.envpos[v]
+        cdef float velocity = self.gain[v] * volume
+        cdef int moving
+        if self.isfadeout[v]:
+            env = self.envrelease[v]
+            envlength = self.envreleaselength[v]
+            clock = self.fadeoutpos[v]
+            velocity *= self.releaselevel[v]
+        moving = (envlength - 1) * ENVBLOCK        # frames until the envelope stops moving
+
+        if self.loop[v] == -1 and pos + (frame_count - first) * speed > length - 4:       # one-shot sample ends in this buffer
+            N = first + <int> ((length - 4 - pos) / speed)
+            if N < first:
+                N = first
+            ended = 1
+
+        if pos + (N - first) * speed + SINCTAPS < self.headlength[v]:     # the whole buffer plays from the in-RAM head
+            zz = self.headdata[v]
+
+        if self.interpolation == INTERP_SINC:
+            while band < SINCBANDS - 1 and bandspeed < speed * 0.999:
+                bandspeed *= 1.18920712     # 2 ** (1 / 4.)
+                band += 1
+            table = self.sinctable + band * SINCPHASES * SINCTAPS
+
+        if self.isfloat[v]:
+            pos = mixsamples(<float *> zz, bb, first, N, pos, speed, self.channels[v], length, self.loop[v], velocity, env, envlength, clock,
+                             self.interpolation, table)
+        else:
+            pos = mixsamples(<short *> zz, bb, first, N, pos, speed, self.channels[v], length, self.loop[v], velocity, env, envlength, clock,
+                             self.interpolation, table)
+
+        clock += N - first
+        if self.isfadeout[v]:
+            if clock >= moving:
+                ended = 1
+            self.fadeoutpos[v] = clock
+        else:
+            self.envpos[v] = min(clock, moving)
+        self.startoffset[v] = 0
+        self.pos[v] = pos
+        return ended
+
+
+@cython.boundscheck(False)
+cdef double mixsamples(sample_t *zz, float *bb, int first, int N, double pos, float speed, int ch, int length, int loop,
+                       float velocity, float *env, int envlength, int clock, int interpolation, float *table) nogil:
+    """The frames first..N-1 of a voice, from position pos of its samples zz (int16 or float32). Returns the new position.
+    Frame `first` is at frame `clock` of the envelope table env (envlength entries) and the gain is velocity times the
+    envelope: a carried ramp, its slope is updated every ENVBLOCK frames (dgain is 0 once sustained). table holds the
+    sinc coefficients of the voice's band."""
+    cdef int i, k, l, r, left
+    cdef int step = <int> speed
+    cdef float multiplier, dgain
+    cdef float j
+    cdef float *h
+    if step == speed and step >= 1 and pos == <int> pos and (step == 1 or interpolation != INTERP_SINC):
+        return mixstride(bb, zz, first, N, <int> pos, step, ch, length, loop, velocity, env, envlength, clock)
+    left = envchunk(velocity, env, envlength, clock, N - first, &multiplier, &dgain)
+    if interpolation == INTERP_LINEAR:
+        for i in range(first, N):
+            if left == 0:               # next envelope table entry
+                left = envchunk(velocity, env, envlength, clock + i - first, N - i, &multiplier, &dgain)
+            k = <int> pos
+            if k > length - 2:
+                pos = loop + 1
+                k = <int> pos
+            j = pos - k
+            l = ch * k                  # left and right sample of frame k, the same one for mono
+            r = l + ch - 1
+            bb[2 * i] += (zz[l] + j * (zz[l + ch] - zz[l])) * multiplier             # linear interpolation
+            bb[2 * i + 1] += (zz[r] + j * (zz[r + ch] - zz[r])) * multiplier
+            multiplier += dgain
+            left -= 1
+            pos += speed
+    elif interpolation == INTERP_CUBIC:
+        for i in range(first, N):
+            if left == 0:               # next envelope table entry
+                left = envchunk(velocity, env, envlength, clock + i - first, N - i, &multiplier, &dgain)
+            k = <int> pos
+            if k > length - 2:
+                pos = loop + 1
+                k = <int> pos
+            j = pos - k
+            bb[2 * i] += hermite(zz, k, j, ch, 0, length - 1) * multiplier
+            bb[2 * i + 1] += hermite(zz, k, j, ch, ch - 1, length - 1) * multiplier
+            multiplier += dgain
+            left -= 1
+            pos += speed
+    else:
+        for i in range(first, N):
+            if left == 0:               # next envelope table entry
+                left = envchunk(velocity, env, envlength, clock + i - first, N - i, &multiplier, &dgain)
+            k = <int> pos
+            if k > length - 2:
+                pos = loop + 1
+                k = <int> pos
+            j = pos - k
+            h = table + (<int> (j * SINCPHASES)) * SINCTAPS
+            bb[2 * i] += sinc(zz, k, h, ch, 0, length - 1) * multiplier
+            bb[2 * i + 1] += sinc(zz, k, h, ch, ch - 1, length - 1) * multiplier
+            multiplier += dgain
+            left -= 1
+            pos += speed
+    return pos
+
+
+#########################################
+# KEYMAP
+#########################################
+
+cdef class Keymap:
+    """The (midinote, velocity) -> Sound table of a preset, looked up at each note-on.
+
+    A 128 x 128 int16 table points into a dense list of groups: the samples defined for one key,
+    played in turn when there are several (round-robin). Keys without samples of their own use
+    the velocity layer below (or the lowest layer), notes without samples use the note below."""
+    cdef numpy.ndarray table          # group index per (midinote, velocity), -1 = nothing to play
+    cdef short *index
+    cdef list groups                  # group -> [(order, n, sound)] sorted by order
+    cdef list rrpos                   # group -> next round-robin position
+    cdef dict keys                    # (midinote, velocity) -> group, for the keys with samples of their own
+
+    def __cinit__(self):
+        self.table = numpy.empty((128, 128), numpy.int16)
+        self.table.fill(-1)
+        self.index = <short *> (self.table.data)
+        self.groups = []
+        self.rrpos = []
+        self.keys = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, int midinote, int velocity, sound, order=0):
+        """Add a sample of its own to a key, the samples of a key are played in turn by increasing order.
+        It becomes playable at the next fill()."""
+        if midinote < 0 or midinote > 127 or velocity < 0 or velocity > 127:
+            return
+        g = self.keys.get((midinote, velocity))
+        if g is None:
+            g = len(self.groups)
+            self.groups.append([])
+            self.rrpos.append(0)
+            self.keys[midinote, velocity] = g
+        bisect.insort(self.groups[g], (order, len(self.groups[g]), sound))
+
+    def fill(self):
+        """Rebuild the whole table from the keys with samples of their own, with numpy (about 0.1 ms).
+        Safe while lookup() is used from another thread: every entry is valid at all times."""
+        own = numpy.empty((128, 128), numpy.int16)
+        own.fill(-1)
+        if self.keys:
+            notes, velocities = zip(*self.keys.keys())
+            own[notes, velocities] = self.keys.values()
+        has = own >= 0
+        layer = numpy.maximum.accumulate(numpy.where(has, numpy.arange(128), -1), axis=1)   # own layer at or below
+        layer = numpy.where(layer >= 0, layer, has.argmax(axis=1)[:, None])                 # else the lowest layer
+        layered = own[numpy.arange(128)[:, None], layer]
+        below = numpy.maximum.accumulate(numpy.where(has.any(axis=1), numpy.arange(128), -1))   # sampled note at or below
+        self.table[...] = numpy.where(below[:, None] >= 0, layered[below.clip(0)], -1)
+
+    def lookup(self, int midinote, int velocity):
+        """The Sound to play for a note-on, or None. No allocation: called from the MIDI callback."""
+        cdef int g, n, p
+        cdef list group
+        if midinote < 0 or midinote > 127 or velocity < 0 or velocity > 127:
+            return None
+        g = self.index[midinote * 128 + velocity]
+        if g < 0:
+            return None
+        group = self.groups[g]
+        n = len(group)
+        if n == 1:
+            return group[0][2]
+        p = self.rrpos[g] % n
+        self.rrpos[g] = (p + 1) % n
+        return group[p][2]
+
+    def items(self):
+        """[(midinote, velocity, order, sound)] for all the samples added."""
+        return [(key[0], key[1], order, sound) for key, g in self.keys.items() for order, n, sound in self.groups[g]]
+
+    def sounds(self):
+        return [sound for group in self.groups for order, n, sound in group]
+
+    def reach(self):
+        """[(sound, highest midinote that plays it)], to know how far up each sample can be pitched."""
+        highest = numpy.full(len(self.groups), -1, numpy.int32)
+        notes = numpy.arange(128).repeat(128).reshape(128, 128)
+        used = self.table >= 0
+        numpy.maximum.at(highest, self.table[used], notes[used])
+        return [(sound, highest[g]) for g, group in enumerate(self.groups) for order, n, sound in group]
@@ -0,0 +1,121 @@
+#
+#  SamplerBox
+#
+#  author:    Joseph Ernest (twitter: @JosephErnest, mail: contact@samplerbox.org)
+#  url:       http://www.samplerbox.org/
+#  license:   Creative Commons ShareAlike 3.0 (http://creativecommons.org/licenses/by-sa/3.0/)
+#
+#  samplerbox_latency.py: Adaptive buffer size and polyphony
+#
+#  The audio callback reports how long each mix took and whether PortAudio flagged an underflow.
+#  Once per window, a low-priority thread compares the callback times with the buffer period
+#  (the deadline) and decides:
+#    - callbacks close to the deadline for several windows in a row: lower the effective polyphony
+#    - xruns: ask for the next bigger buffer size (latency profile), or shed voices at the biggest
+#    - several calm windows: give the voices back
+#  The buffer size only grows, and the new size is applied by the caller when reopening the cards
+#  does not interrupt playing notes (between presets): smaller buffers are never tried again.
+#
+
+
+import time
+import collections
+
+
+class LatencyController:
+
+    def __init__(self, profiles, frames, maxvoices, rate=44100, window=1.0, high=0.7, low=0.35, hotwindows=3, calmwindows=5):
+        self.profiles = sorted(profiles)        # buffer sizes to grow to, in frames
+        self.frames = frames                    # current buffer size
+        self.maxvoices = maxvoices
+        self.voicelimit = maxvoices             # effective polyphony
+        self.minvoices = max(1, maxvoices // 4)
+        self.rate = rate
+        self.window = window                    # seconds between two decisions
+        self.high = high                        # peak callback time / buffer period above which load is shed
+        self.low = low                          # ... below which it is considered calm
+        self.hotwindows = hotwindows            # windows in a row above high before voices are shed
+        self.calmwindows = calmwindows
+        self.hot = 0
+        self.calm = 0
+        # written by the audio thread only (plain attribute updates, no lock)
+        self.callbacks = 0
+        self.busy = 0.0
+        self.peak = 0.0
+        self.xruns = 0
+        self.outputlatency = 0.0
+        # snapshot of the previous window, controller thread only
+        self.lastcallbacks = 0
+        self.lastbusy = 0.0
+        self.lastxruns = 0
+        self.load = 0.0
+        self.peakload = 0.0
+        self.changes = collections.deque(maxlen=20)     # (time, frames, voicelimit, reason), newest last
+
+    def callback(self, duration, underflow, outputlatency):
+        """Called at the end of each audio callback: duration of the mix in seconds, PortAudio underflow flag,
+        time until the buffer reaches the DAC (time_info['output_buffer_dac_time'] - time_info['current_time'])."""
+        self.callbacks += 1
+        self.busy += duration
+        if duration > self.peak:
+            self.peak = duration
+        if underflow:
+            self.xruns += 1
+        self.outputlatency = outputlatency
+
+    def update(self, now=None):
+        """Decision for the last window. Returns the new buffer size if the streams should be reopened (the caller
+        does it when it will not interrupt notes), else None. voicelimit is updated in place, the caller applies it to the mixer."""
+        now = time.time() if now is None else now
+        callbacks, busy, xruns = self.callbacks, self.busy, self.xruns
+        peak, self.peak = self.peak, 0.0
+        n = callbacks - self.lastcallbacks
+        newxruns = xruns - self.lastxruns
+        period = float(self.frames) / self.rate
+        if n > 0:
+            self.load = (busy - self.lastbusy) / (n * period)
+            self.peakload = peak / period
+        self.lastcallbacks, self.lastbusy, self.lastxruns = callbacks, busy, xruns
+        if n == 0:
+            return None
+        bigger = [f for f in self.profiles if f > self.frames]
+        if newxruns:
+            self.calm = 0
+            self.hot = 0
+            if bigger:
+                return self.change(now, bigger[0], self.voicelimit, '%d xruns' % newxruns)
+            if self.voicelimit > self.minvoices:
+                return self.change(now, None, max(self.minvoices, self.voicelimit * 3 // 4), '%d xruns at the biggest buffer' % newxruns)
+        elif self.peakload > self.high:
+            self.calm = 0
+            self.hot += 1
+            if self.hot >= self.hotwindows and self.voicelimit > self.minvoices:     # not for a single peak
+                self.hot = 0
+                return self.change(now, None, max(self.minvoices, self.voicelimit * 3 // 4), 'peak load %.0f%%' % (100 * self.peakload))
+        elif self.peakload < self.low:
+            self.hot = 0
+            self.calm += 1
+            if self.calm >= self.calmwindows:
+                self.calm = 0
+                if self.voicelimit < self.maxvoices:
+                    return self.change(now, None, min(self.maxvoices, self.voicelimit + max(1, self.voicelimit // 4)), 'calm')
+        else:
+            self.hot = 0
+            self.calm = 0
+        return None
+
+    def change(self, now, frames, voicelimit, reason):
+        self.voicelimit = voicelimit
+        self.changes.append((now, frames or self.frames, voicelimit, reason))
+        if frames is None or frames == self.frames:
+            return None
+        self.frames = frames
+        self.peak = 0.0     # the callbacks of the old buffer size do not count
+        return frames
+
+    def stats(self):
+        """Current policy and the measurements it is based on, e.g. to tune the profiles for a Pi model."""
+        return {'frames': self.frames, 'latency_ms': 1000.0 * self.frames / self.rate, 'profiles': self.profiles,
+                'voicelimit': self.voicelimit, 'maxvoices': self.maxvoices, 'load': self.load, 'peakload': self.peakload,
+                'callbacks': self.callbacks, 'xruns': self.xruns, 'outputlatency_ms': 1000.0 * self.outputlatency,
+                'changes': list(self.changes)}
@@ -0,0 +1,104 @@
+#
+#  SamplerBox
+#
+#  author:    Joseph Ernest (twitter: @JosephErnest, mail: contact@samplerbox.org)
+#  url:       http://www.samplerbox.org/
+#  license:   Creative Commons ShareAlike 3.0 (http://creativecommons.org/licenses/by-sa/3.0/)
+#
+#  samplerbox_stats.py: Statistics exporter
+#
+#  The audio and MIDI callbacks only bump counters and histogram bins (see Histogram in
+#  samplerbox_engine.pxi). This low-priority thread takes a snapshot of them every few
+#  seconds and publishes it as one JSON object:
+#    - appended as a line to a file ('-' = standard output)
+#    - served on a UNIX socket: each connection receives the last snapshot, e.g.
+#      socat - UNIX-CONNECT:/tmp/samplerbox.sock
+#
+
+
+import os
+import sys
+import time
+import json
+import socket
+import threading
+
+
+def percentile(bins, q):
+    """Upper edge in microseconds of the log2 bin (see Histogram) holding the q-th percentile, 0 if empty."""
+    total = sum(bins)
+    if not total:
+        return 0
+    seen = 0
+    for b, n in enumerate(bins):
+        seen += n
+        if seen >= q / 100.0 * total:
+            return 2 ** (b + 1)
+    return 2 ** len(bins)
+
+
+def summarize(snapshot):
+    """Add p50/p99 to the histograms of a snapshot (dicts with 'bins'), in place."""
+    for key, value in snapshot.items():
+        if isinstance(value, dict):
+            if 'bins' in value:
+                value['p50_us'] = percentile(value['bins'], 50)
+                value['p99_us'] = percentile(value['bins'], 99)
+            else:
+                summarize(value)
+    return snapshot
+
+
+class StatsExporter(threading.Thread):
+
+    def __init__(self, sources, interval, path='', socketpath=''):
+        """sources: {name: function returning a dict}, called from this thread at each snapshot."""
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sources = sources
+        self.interval = interval
+        self.path = path
+        self.socketpath = socketpath
+        self.last = '{}\n'
+
+    def snapshot(self):
+        snapshot = {'time': time.time()}
+        for name, source in self.sources.items():
+            snapshot[name] = source()
+        return summarize(snapshot)
+
+    def run(self):
+        try:
+            os.nice(10)         # Linux: only this thread, the audio and MIDI threads keep their priority
+        except OSError:
+            pass
+        if self.socketpath:
+            server = threading.Thread(target=self.serve)
+            server.daemon = True
+            server.start()
+        while True:
+            time.sleep(self.interval)
+            self.last = json.dumps(self.snapshot()) + '\n'
+            if self.path == '-':
+                sys.stdout.write(self.last)
+                sys.stdout.flush()
+            elif self.path:
+                try:
+                    with open(self.path, 'a') as f:
+                        f.write(self.last)
+                except IOError:
+                    pass
+
+    def serve(self):
+        if os.path.exists(self.socketpath):
+            os.remove(self.socketpath)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socketpath)
+        server.listen(4)
+        while True:
+            connection, address = server.accept()
+            try:
+                connection.sendall(self.last)
+            except socket.error:
+                pass
+            connection.close()
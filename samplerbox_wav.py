@@ -0,0 +1,118 @@
+#
+#  SamplerBox
+#
+#  author:    Joseph Ernest (twitter: @JosephErnest, mail: contact@samplerbox.org)
+#  url:       http://www.samplerbox.org/
+#  license:   Creative Commons ShareAlike 3.0 (http://creativecommons.org/licenses/by-sa/3.0/)
+#
+#  samplerbox_wav.py: WAV file reader
+#
+#  scan() maps the file and walks its RIFF chunks in place (no chunk objects, no reads of
+#  the sample data): format, data chunk offset and length, cue markers and smpl loops, the
+#  records of which are unpacked with one numpy.frombuffer each.
+#  read() reads the sample data with one bulk read into the final array, or into a byte
+#  buffer then converted without the GIL: 8/16/24/32-bit integer PCM and 32-bit float, to
+#  int16 or to float32. float32 samples keep the int16 scale (full scale = 32768) and the
+#  low bits of 24-bit and float files.
+#
+
+
+import mmap
+import struct
+import numpy
+import samplerbox_audio          # conversion kernels (same in samplerbox_audio_neon)
+
+PCM = 1
+IEEE_FLOAT = 3
+EXTENSIBLE = 0xFFFE         # the actual format is in the first 2 bytes of the sub-format GUID
+
+
+class WavInfo(object):
+
+    def __init__(self):
+        self.format = PCM
+        self.channels = 0
+        self.rate = 0
+        self.sampwidth = 0      # bytes per sample
+        self.dataoffset = 0     # from the start of the file
+        self.nframes = 0
+        self.markers = []       # cue sample offsets
+        self.loops = []         # [start, end] frames of the smpl loops
+
+    def isint16(self):
+        """True if the data can be used as it is (numpy.memmap) by the mixer."""
+        return self.format == PCM and self.sampwidth == 2
+
+
+def scan(filename):
+    with open(filename, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return walk(m)
+    finally:
+        m.close()
+
+def walk(m):
+    if len(m) < 12 or m[0:4] != 'RIFF' or m[8:12] != 'WAVE':
+        raise ValueError('not a RIFF/WAVE file')
+    info = WavInfo()
+    datasize = None
+    pos, end = 12, len(m)
+    while pos + 8 <= end:
+        name, size = struct.unpack_from('<4sI', m, pos)
+        body = pos + 8
+        if name == 'fmt ':
+            info.format, info.channels, info.rate, blockalign, bits = struct.unpack_from('<HHIxxxxHH', m, body)
+            if info.format == EXTENSIBLE and size >= 26:
+                info.format = struct.unpack_from('<H', m, body + 24)[0]
+            info.sampwidth = (bits + 7) // 8
+        elif name == 'data':
+            info.dataoffset = body
+            datasize = min(size, end - body)        # truncated files play what is there
+        elif name == 'cue ' and size >= 4:
+            n = min(struct.unpack_from('<I', m, body)[0], (size - 4) // 24)
+            info.markers = numpy.frombuffer(m[body + 4:body + 4 + 24 * n], '<i4').reshape(n, 6)[:, 5].tolist()
+        elif name == 'smpl' and size >= 36:
+            n = min(struct.unpack_from('<I', m, body + 28)[0], (size - 36) // 24)
+            info.loops = numpy.frombuffer(m[body + 36:body + 36 + 24 * n], '<i4').reshape(n, 6)[:, 2:4].tolist()
+        pos = body + size + (size & 1)          # chunks are padded to an even size
+    if not info.channels or datasize is None:
+        raise ValueError('fmt chunk and/or data chunk missing')
+    if info.format not in (PCM, IEEE_FLOAT) or info.sampwidth not in (1, 2, 3, 4) or (info.format == IEEE_FLOAT and info.sampwidth != 4):
+        raise ValueError('unsupported WAV format %d, %d bytes per sample' % (info.format, info.sampwidth))
+    info.nframes = datasize // (info.channels * info.sampwidth)
+    return info
+
+
+def read(filename, info, nframes=None, dtype=numpy.int16, dither=False):
+    """The first nframes (default all) of the file's samples, interleaved, as int16 or float32.
+    The file is read straight into the result (16-bit to int16, float to float32) or into one byte
+    buffer converted into the result by the nogil kernels of samplerbox_audio. dither: 24-bit to int16
+    with TPDF dither instead of truncation."""
+    nframes = info.nframes if nframes is None else min(nframes, info.nframes)
+    n = nframes * info.channels
+    data = numpy.empty(n, dtype)
+    native = (info.format == PCM and info.sampwidth == 2 and dtype == numpy.int16) or \
+             (info.format == IEEE_FLOAT and dtype == numpy.float32)
+    raw = data if native else numpy.empty(n * info.sampwidth, numpy.uint8)
+    with open(filename, 'rb') as f:
+        f.seek(info.dataoffset)
+        got = f.readinto(raw)
+    raw.view(numpy.uint8)[got:] = 0
+    if info.format == IEEE_FLOAT:
+        if native:
+            data *= 32768
+        else:
+            samplerbox_audio.convertfloat(raw.view(numpy.float32), data)
+    elif info.sampwidth == 2:
+        if not native:
+            data[:] = raw.view(numpy.int16)
+    elif info.sampwidth == 3:
+        samplerbox_audio.convert24(raw, data, dither)
+    elif info.sampwidth == 1:
+        samplerbox_audio.convert8(raw, data)
+    elif dtype == numpy.int16:
+        numpy.right_shift(raw.view(numpy.int32), 16, out=data, casting='unsafe')
+    else:
+        numpy.multiply(raw.view(numpy.int32), 1.0 / 65536, out=data, casting='unsafe')
+    return data